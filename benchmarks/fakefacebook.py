@@ -0,0 +1,115 @@
+"""
+A local stand-in for the parts of the Graph API django_facebook talks to:
+
+- ``/<version>/oauth/access_token``: hands out an access_token for any code
+- ``/<version>/me``: the user the access_token belongs to
+- ``/<version>/me/friends``: a paged list of friends
+- ``POST /<version>/``: batch requests
+
+Access tokens are ``token-<facebook id>``, and a code ``code-<facebook id>``
+is exchanged for the access_token of that user.
+"""
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+FRIENDS_COUNT = 2000
+
+
+class FakeFacebookHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, like facebook does, and send every response
+    # in one go so keep-alive connections don't wait for delayed acks.
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-App-Usage', '{"call_count":1,"total_cputime":1,'
+                                        '"total_time":1}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, path, args):
+        """Return the json answer for a GET of path with the args."""
+        fb_id = args.get('access_token', '').replace('token-', '')
+        full_path = path.strip('/')
+        # strip the api version
+        path = full_path.partition('/')[2]
+        if path == 'oauth/access_token':
+            if 'fb_exchange_token' in args:
+                token = args['fb_exchange_token']
+            else:
+                token = args.get('code', '').replace('code-', 'token-')
+            return {'access_token': token, 'expires': 5183999,
+                    'expires_in': 5183999}
+        if not fb_id:
+            return {'error': {'message': 'An access token is required',
+                              'type': 'OAuthException', 'code': 104}}
+        if path == 'me':
+            return {'id': fb_id, 'name': 'User %s' % fb_id}
+        if path == 'me/friends':
+            limit = int(args.get('limit', 500))
+            after = int(args.get('after', 0))
+            end = min(after + limit, FRIENDS_COUNT)
+            data = {'data': [{'id': str(i), 'name': 'Friend %s' % i}
+                             for i in range(after, end)]}
+            if end < FRIENDS_COUNT:
+                data['paging'] = {'next': '%s%s?access_token=%s&limit=%s'
+                                  '&after=%s' % (self.server.url, full_path,
+                                                 args['access_token'], limit,
+                                                 end)}
+            return data
+        return {'id': path}
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        args = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.send_json(self.answer(url.path, args))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        token = form.get('access_token', [''])[0]
+        responses = []
+        for call in json.loads(form['batch'][0]):
+            url = urlsplit('/v/' + call['relative_url'])
+            args = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            args.setdefault('access_token', token)
+            responses.append({'code': 200,
+                              'body': json.dumps(self.answer(url.path, args))})
+        self.send_json(responses)
+
+
+class FakeFacebookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_port
+
+
+def start_server():
+    """
+    Start a fake facebook server on a free port, in a background thread.
+    Returns the server, its base url is ``server.url``.
+    """
+    server = FakeFacebookServer(('127.0.0.1', 0), FakeFacebookHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,307 @@
+"""
+Benchmarks of the django_facebook hot paths, run against a local fake
+facebook server (see ``fakefacebook``) with the throwaway ``settings``.
+
+Run it from the root of the repository::
+
+    python benchmarks/run.py --iterations 2000 --output results.json
+
+For every scenario the requests/second and the p50 and p99 latency are
+written as json, so results of different versions can be compared by a
+script.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakefacebook import start_server  # noqa
+
+SCENARIOS = []
+
+
+def scenario(func):
+    SCENARIOS.append(func)
+    return func
+
+
+def make_signed_request(fb_id):
+    from django.conf import settings
+    payload = json.dumps({'algorithm': 'HMAC-SHA256', 'user_id': fb_id,
+                          'code': 'code-%s' % fb_id,
+                          'issued_at': int(time.time())})
+    payload = base64.urlsafe_b64encode(payload.encode('utf-8')).rstrip(b'=')
+    sig = hmac.new(settings.FACEBOOK_APP_SECRET.encode('ascii'), payload,
+                   hashlib.sha256).digest()
+    sig = base64.urlsafe_b64encode(sig).rstrip(b'=')
+    return (sig + b'.' + payload).decode('ascii')
+
+
+def cookie_name():
+    from django_facebook import conf
+    return conf.COOKIE_NAME
+
+
+def logged_in_client(fb_id):
+    from django.test import Client
+    client = Client()
+    client.cookies[cookie_name()] = make_signed_request(fb_id)
+    client.get('/')
+    return client
+
+
+def timed(func):
+    start = default_timer()
+    func()
+    return default_timer() - start
+
+
+@scenario
+def anonymous(iterations):
+    """Requests without any facebook cookie or session."""
+    from django.test import Client
+    client = Client()
+    return [timed(lambda: client.get('/')) for _ in range(iterations)]
+
+
+@scenario
+def cookie_login(iterations):
+    """
+    Fresh sessions with a ``fbsr_`` cookie, so every request logs a user in.
+    Half of the users are new, so this is a signup/login spike.
+    """
+    from django.test import Client
+    timings = []
+    for i in range(iterations):
+        client = Client()
+        client.cookies[cookie_name()] = make_signed_request(
+            str(1000000 + i // 2))
+        timings.append(timed(lambda: client.get('/')))
+    return timings
+
+
+# Facebook ids for cookie_login_concurrent, fresh for every run
+_concurrent_ids = [5000000]
+
+
+@scenario
+def cookie_login_concurrent(iterations):
+    """
+    ``cookie_login`` from 4 threads at once, that all log in the same new
+    users, so the same users are created concurrently.
+    """
+    from django.db import connection
+    from django.test import Client
+    threads = 4
+    rounds = max(1, iterations // threads)
+    first = _concurrent_ids[0]
+    _concurrent_ids[0] += rounds
+    timings = []
+
+    def work():
+        try:
+            for i in range(rounds):
+                client = Client()
+                client.cookies[cookie_name()] = make_signed_request(
+                    str(first + i))
+                timings.append(timed(lambda: client.get('/')))
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return timings
+
+
+@scenario
+def authenticated(iterations):
+    """Requests of a user that is already logged in with facebook."""
+    client = logged_in_client('42')
+    return [timed(lambda: client.get('/')) for _ in range(iterations)]
+
+
+@scenario
+def logout(iterations):
+    """Requests that log the user out, because the cookie is gone."""
+    timings = []
+    for i in range(iterations):
+        client = logged_in_client(str(2000000 + i % 100))
+        del client.cookies[cookie_name()]
+        timings.append(timed(lambda: client.get('/')))
+    return timings
+
+
+@scenario
+def server_login(iterations):
+    """``fb_server_login``: code exchange and user lookup via facebook."""
+    from django.test import Client
+    timings = []
+    for i in range(iterations):
+        client = Client()
+        url = '/fb/login/?code=code-%s' % (3000000 + i % 100)
+        timings.append(timed(lambda: client.get(url)))
+    return timings
+
+
+def _middleware_request(fb_id=None, session_key=None):
+    from django.conf import settings
+    from django.contrib.auth.middleware import AuthenticationMiddleware
+    from django.contrib.sessions.middleware import SessionMiddleware
+    from django.test import RequestFactory
+    request = RequestFactory().get('/')
+    if fb_id:
+        request.COOKIES[cookie_name()] = make_signed_request(fb_id)
+    if session_key:
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+    SessionMiddleware().process_request(request)
+    AuthenticationMiddleware().process_request(request)
+    return request
+
+
+def _legacy_chain(request):
+    from django_facebook.middleware import (FacebookHelperMiddleware,
+                                            FacebookLoginMiddleware,
+                                            FacebookLogOutMiddleware)
+    FacebookHelperMiddleware().process_request(request)
+    FacebookLogOutMiddleware().process_request(request)
+    FacebookLoginMiddleware().process_request(request)
+
+
+def _fused(request):
+    from django_facebook.middleware import FacebookMiddleware
+    FacebookMiddleware().process_request(request)
+
+
+@scenario
+def middleware_anonymous_legacy(iterations):
+    """The helper/logout/login chain on anonymous requests."""
+    requests = [_middleware_request() for _ in range(iterations)]
+    return [timed(lambda: _legacy_chain(r)) for r in requests]
+
+
+@scenario
+def middleware_anonymous_fused(iterations):
+    """``FacebookMiddleware`` on anonymous requests."""
+    requests = [_middleware_request() for _ in range(iterations)]
+    return [timed(lambda: _fused(r)) for r in requests]
+
+
+@scenario
+def helper_unused(iterations):
+    """
+    ``FacebookHelperMiddleware`` for a logged in user, on a page that doesn't
+    use ``request.facebook``.
+    """
+    from django.conf import settings
+    from django_facebook.middleware import FacebookHelperMiddleware
+    client = logged_in_client('42')
+    session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+    requests = [_middleware_request('42', session_key)
+                for _ in range(iterations)]
+    middleware = FacebookHelperMiddleware()
+    return [timed(lambda: middleware.process_request(r)) for r in requests]
+
+
+@scenario
+def friends_sync(iterations):
+    """Syncing 2000 friends, in pages of 100, from the fake server."""
+    from django_facebook.sync import FriendsSync
+    iterations = max(1, iterations // 100)
+    return [timed(lambda: FriendsSync('42', 'token-42', lambda b: None,
+                                      page_size=100).run())
+            for _ in range(iterations)]
+
+
+@scenario
+def template_tags(iterations):
+    """Rendering the facebook template tags of a base template."""
+    from django.template import Context, Template
+    from django.test import RequestFactory
+    template = Template(
+        '{% load facebook %}'
+        '{% facebook_init %}FB.getLoginStatus();{% endfacebook_init %}'
+        '{% facebook_load %}'
+        '<a href="{% facebook_login_url request "benchmark_page" %}">Log in</a>')
+    request = RequestFactory().get('/')
+    return [timed(lambda: template.render(Context({'request': request})))
+            for _ in range(iterations)]
+
+
+def summarize(timings, elapsed):
+    """
+    Summarize the latencies of a scenario that took ``elapsed`` seconds on
+    the wall clock, which is what the throughput is measured over, as the
+    latencies of concurrent scenarios overlap.
+    """
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'rps': round(len(timings) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(timings[int(len(timings) * 0.5)] * 1000, 3),
+        'p99_ms': round(timings[min(len(timings) - 1,
+                                    int(len(timings) * 0.99))] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--output', help='file to write the json to, '
+                                         'defaults to stdout')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, defaults to all')
+    options = parser.parse_args()
+
+    server = start_server()
+    os.environ['BENCHMARK_GRAPH_URL'] = server.url
+    tmp = tempfile.mkdtemp()
+    os.environ['BENCHMARK_DATABASE'] = os.path.join(tmp, 'db.sqlite3')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+    results = {}
+    for func in SCENARIOS:
+        if options.scenarios and func.__name__ not in options.scenarios:
+            continue
+        # warm up caches, connections and the like
+        func(10)
+        start = default_timer()
+        timings = func(options.iterations)
+        results[func.__name__] = summarize(timings, default_timer() - start)
+        sys.stderr.write('%s: %s\n' % (func.__name__, results[func.__name__]))
+
+    output = json.dumps({
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'iterations': options.iterations,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
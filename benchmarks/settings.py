@@ -0,0 +1,50 @@
+"""
+Throwaway settings for running the benchmarks, see ``run.py``.
+"""
+import os
+
+SECRET_KEY = 'benchmarks'
+DEBUG = False
+ALLOWED_HOSTS = ['testserver']
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django_facebook',
+]
+
+# A file, set by run.py, so threads of the concurrent scenarios share it
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCHMARK_DATABASE', ':memory:'),
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+
+MIDDLEWARE_CLASSES = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django_facebook.middleware.FacebookMiddleware',
+]
+AUTHENTICATION_BACKENDS = ['django_facebook.auth.FacebookModelBackend']
+ROOT_URLCONF = 'benchmarks.urls'
+
+FACEBOOK_APP_ID = '1234'
+FACEBOOK_APP_SECRET = 'benchmark-secret'
+FACEBOOK_REDIRECT_URI = 'http://testserver/'
+FACEBOOK_LOGIN_REDIRECT_URL = 'benchmark_page'
+# Set by run.py to the url of the fake facebook server
+FACEBOOK_GRAPH_URL = os.environ.get('BENCHMARK_GRAPH_URL',
+                                    'http://127.0.0.1:1/')
+
+# Measure the package, not the pacing of background work
+FACEBOOK_RATE_LIMIT_APP_RATE = None
+FACEBOOK_RATE_LIMIT_USER_RATE = None
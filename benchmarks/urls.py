@@ -0,0 +1,12 @@
+from django.conf.urls import include, url
+from django.http import HttpResponse
+
+
+def page(request):
+    return HttpResponse('user: %s' % request.facebook.user_id)
+
+
+urlpatterns = [
+    url(r'^$', page, name='benchmark_page'),
+    url(r'^fb/', include('django_facebook.urls')),
+]
@@ -4,14 +4,16 @@ import logging
 from django.contrib import auth as django_auth
 from django.contrib.auth import BACKEND_SESSION_KEY, get_user_model, SESSION_KEY
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.signals import user_logged_in
-from django_facebook.signals import facebook_user_created
-from django_facebook.utils import (cache_access_token, del_cached_access_token,
-                                   del_cached_fb_user_data,
+from django.db import IntegrityError, transaction
+from django_facebook import stats
+from django_facebook.registry import get_current_app
+from django_facebook.dispatch import user_created
+from django_facebook.utils import (FACEBOOK_BACKEND, cache_access_token,
+                                   del_cached_fb_users,
                                    get_signed_request_data)
 
-import conf
-
 User = get_user_model()
 
 log = logging.getLogger('django_facebook.auth')
@@ -49,17 +51,28 @@ def logout(request):
     Logout the user, delete cached data and clear cookies so any auth calls
     coming after don't log the user in again.
     """
-    user_id = request.user.get_username()
-    del_cached_fb_user_data(user_id)
-    del_cached_access_token(user_id)
+    del_cached_fb_users([request.user.get_username()])
     django_auth.logout(request)
 
     try:
-        del request.COOKIES[conf.COOKIE_NAME]
+        del request.COOKIES[get_current_app().cookie_name]
     except KeyError:
         pass
 
 
+def get_stateless_user(user_id):
+    """
+    Return the user for the facebook id without touching the session, for
+    FACEBOOK_STATELESS mode. The facebook id must come from a verified
+    signed_request.
+    """
+    user = FacebookModelBackend().get_user(user_id)
+    if user is None:
+        return AnonymousUser()
+    user.backend = FACEBOOK_BACKEND
+    return user
+
+
 class FacebookModelBackend(ModelBackend):
 
     create_on_not_found = True
@@ -93,23 +106,43 @@ class FacebookModelBackend(ModelBackend):
 
         return user
 
+    @stats.timer('auth.get_user')
     def get_user(self, user_id, access_token=None):
         """
         Lookup the user by their facebook id, and create a new one if they
         don't exist yet. Upon creation the facebook_user_created signal is
-        fired. For this reason you really should pass a valid access_token for
-        this user, so that connecting functions can actually do something
-        usefull, like pre-fetching user data.
+        fired, or queued depending on FACEBOOK_USER_CREATED_DISPATCH. For this
+        reason you really should pass a valid access_token for this user, so
+        that connecting functions can actually do something usefull, like
+        pre-fetching user data.
         """
         log.debug('FacebookModelBackend.get_user called')
-        if self.create_on_not_found:
-            user, created = User.objects.get_or_create(
-                **{User.USERNAME_FIELD: user_id,
-                   'defaults': {'password': '!'}})  # also set unusable password
+        user = self.get_known_user(user_id)
+        if user is None and self.create_on_not_found:
+            user, created = self.create_user(user_id)
             if created:
+                stats.incr('auth.user_created')
                 log.debug('New user created for facebook account %s' % user_id)
-                kwargs = dict(sender=self, user=user, access_token=access_token)
-                facebook_user_created.send_robust(**kwargs)
-            return user
-        else:
-            return User.objects.filter(**{User.USERNAME_FIELD: user_id}).first()
+                user_created(self, user, access_token)
+        return user
+
+    def get_known_user(self, user_id):
+        """
+        Return the existing user for the facebook id, or None.
+        """
+        return User.objects.filter(**{User.USERNAME_FIELD: user_id}).first()
+
+    def create_user(self, user_id):
+        """
+        Create a user with an unusable password for the facebook id. If a
+        concurrent request created it first, return that user instead.
+
+        Returns the user and whether it was created.
+        """
+        try:
+            with transaction.atomic():
+                user = User.objects.create(**{User.USERNAME_FIELD: user_id,
+                                              'password': '!'})
+            return user, True
+        except IntegrityError:
+            return User.objects.get(**{User.USERNAME_FIELD: user_id}), False
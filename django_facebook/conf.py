@@ -14,6 +14,17 @@ except AttributeError:
         'FACEBOOK_APP_SECRET and FACEBOOK_REDIRECT_URI to use django-facebook')
 
 VERSION = getattr(settings, 'FACEBOOK_VERSION', "2.2")
+# Seconds to wait for facebook before giving up on a call
+TIMEOUT = getattr(settings, 'FACEBOOK_TIMEOUT', 10)
+# Where the Graph API lives, point it elsewhere for testing
+GRAPH_URL = getattr(settings, 'FACEBOOK_GRAPH_URL', 'https://graph.facebook.com/')
+# Calls to facebook share keep-alive connections, HTTP_POOL_SIZE are kept per
+# host for HTTP_POOL_HOSTS hosts. Failed idempotent calls are retried
+# HTTP_RETRIES times, waiting HTTP_BACKOFF * 2 ** retry seconds in between.
+HTTP_POOL_SIZE = getattr(settings, 'FACEBOOK_HTTP_POOL_SIZE', 10)
+HTTP_POOL_HOSTS = getattr(settings, 'FACEBOOK_HTTP_POOL_HOSTS', 4)
+HTTP_RETRIES = getattr(settings, 'FACEBOOK_HTTP_RETRIES', 3)
+HTTP_BACKOFF = getattr(settings, 'FACEBOOK_HTTP_BACKOFF', 0.2)
 
 auth = facebook.Auth(APP_ID, APP_SECRET, REDIRECT_URI, VERSION)
 COOKIE_NAME = 'fbsr_%s' % APP_ID
@@ -21,3 +32,94 @@ CANVAS_PAGE = getattr(settings, 'FACEBOOK_CANVAS_PAGE', "")
 DEBUG_SIGNEDREQ = getattr(settings, 'FACEBOOK_DEBUG_SIGNEDREQ', "")
 DEBUG_COOKIE = getattr(settings, 'FACEBOOK_DEBUG_COOKIE', "")
 DEBUG_TOKEN = getattr(settings, 'FACEBOOK_DEBUG_TOKEN', "")
+
+# More facebook apps served by this deployment, see registry
+APPS = getattr(settings, 'FACEBOOK_APPS', {})
+
+# Verified signed_requests are kept in a per-process LRU cache, so the fbsr_
+# cookie isn't decoded and checked again on every request. Set the size to 0
+# to disable the cache.
+SIGNED_REQUEST_CACHE_SIZE = getattr(settings,
+                                    'FACEBOOK_SIGNED_REQUEST_CACHE_SIZE', 1000)
+SIGNED_REQUEST_CACHE_TTL = getattr(settings,
+                                   'FACEBOOK_SIGNED_REQUEST_CACHE_TTL', 600)
+
+# Canvas signed_requests older than CANVAS_MAX_AGE seconds are rejected, and
+# with CANVAS_REJECT_REPLAYS each one is only accepted once. Neither applies
+# to DEBUG_SIGNEDREQ.
+CANVAS_MAX_AGE = getattr(settings, 'FACEBOOK_CANVAS_MAX_AGE', 300)
+CANVAS_REJECT_REPLAYS = getattr(settings, 'FACEBOOK_CANVAS_REJECT_REPLAYS',
+                                False)
+
+# Where access_tokens and user data are cached. Use
+# 'django_facebook.store.TwoTierStore' to keep a short lived copy in process
+# memory in front of the django cache.
+CACHE_STORE = getattr(settings, 'FACEBOOK_CACHE_STORE',
+                      'django_facebook.store.CacheStore')
+LOCAL_CACHE_TTL = getattr(settings, 'FACEBOOK_LOCAL_CACHE_TTL', 5)
+LOCAL_CACHE_SIZE = getattr(settings, 'FACEBOOK_LOCAL_CACHE_SIZE', 10000)
+
+# Exchange short lived access_tokens for long lived ones in the background,
+# and refresh them when they expire within ACCESS_TOKEN_REFRESH_MARGIN
+# seconds. Requires celery.
+EXTEND_ACCESS_TOKENS = getattr(settings, 'FACEBOOK_EXTEND_ACCESS_TOKENS', False)
+ACCESS_TOKEN_REFRESH_MARGIN = getattr(settings,
+                                      'FACEBOOK_ACCESS_TOKEN_REFRESH_MARGIN',
+                                      24 * 3600)
+
+# How long one process may take to exchange a code for an access_token, while
+# other requests of the same user wait for it instead of using the same code.
+ACCESS_TOKEN_LOCK_TIMEOUT = getattr(settings,
+                                    'FACEBOOK_ACCESS_TOKEN_LOCK_TIMEOUT', 15)
+
+# The friends sync passes friends to its callback in batches of about this
+# size, and syncs this many users at the same time.
+SYNC_BATCH_SIZE = getattr(settings, 'FACEBOOK_SYNC_BATCH_SIZE', 5000)
+SYNC_CONCURRENCY = getattr(settings, 'FACEBOOK_SYNC_CONCURRENCY', 10)
+
+# How facebook_user_created is sent: 'sync' during the login, or 'celery' or
+# 'thread' to send it in the background after the transaction commits, in
+# batches of at most USER_CREATED_BATCH_SIZE users collected during at most
+# USER_CREATED_BATCH_INTERVAL seconds.
+USER_CREATED_DISPATCH = getattr(settings, 'FACEBOOK_USER_CREATED_DISPATCH',
+                                'sync')
+USER_CREATED_BATCH_SIZE = getattr(settings,
+                                  'FACEBOOK_USER_CREATED_BATCH_SIZE', 100)
+USER_CREATED_BATCH_INTERVAL = getattr(
+    settings, 'FACEBOOK_USER_CREATED_BATCH_INTERVAL', 1)
+
+# Where metrics of the facebook hot paths are sent, see stats
+STATS_BACKEND = getattr(settings, 'FACEBOOK_STATS_BACKEND',
+                        'django_facebook.stats.NullBackend')
+STATS_PREFIX = getattr(settings, 'FACEBOOK_STATS_PREFIX', 'django_facebook')
+STATSD_ADDRESS = getattr(settings, 'FACEBOOK_STATSD_ADDRESS',
+                         ('localhost', 8125))
+
+# Take the identity of facebook users from the verified fbsr_ cookie on every
+# request, instead of logging them in to the session.
+STATELESS = getattr(settings, 'FACEBOOK_STATELESS', False)
+
+# The fields of request.facebook.profile, mapped to the seconds they may be
+# cached (None for no limit)
+PROFILE_FIELDS = getattr(settings, 'FACEBOOK_PROFILE_FIELDS', {
+    'name': 24 * 3600,
+    'first_name': 24 * 3600,
+    'last_name': 24 * 3600,
+    'email': 24 * 3600,
+})
+
+# The verify token entered when subscribing to webhooks, see views.fb_webhook
+WEBHOOK_VERIFY_TOKEN = getattr(settings, 'FACEBOOK_WEBHOOK_VERIFY_TOKEN', None)
+
+# Graph calls per second background work may make for the app, and for each
+# user (None for no limit). The app rate is lowered when the usage facebook
+# reports goes over RATE_LIMIT_THRESHOLD percent. Seconds to pause when a
+# limit is reached and facebook doesn't say for how long.
+RATE_LIMIT_APP_RATE = getattr(settings, 'FACEBOOK_RATE_LIMIT_APP_RATE', 50)
+RATE_LIMIT_USER_RATE = getattr(settings, 'FACEBOOK_RATE_LIMIT_USER_RATE', 5)
+RATE_LIMIT_THRESHOLD = getattr(settings, 'FACEBOOK_RATE_LIMIT_THRESHOLD', 75)
+RATE_LIMIT_BLOCK_TIME = getattr(settings, 'FACEBOOK_RATE_LIMIT_BLOCK_TIME',
+                                300)
+# Longest a paced call sleeps for a token, ratelimit.RateLimited is raised
+# instead when the wait is longer (None to always wait)
+RATE_LIMIT_MAX_WAIT = getattr(settings, 'FACEBOOK_RATE_LIMIT_MAX_WAIT', 5)
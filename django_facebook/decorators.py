@@ -6,10 +6,11 @@ from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.http import (HttpResponse, HttpResponseBadRequest,
                          HttpResponseRedirect)
 from django.utils.decorators import available_attrs
+from django.utils.html import escape
 from django.utils.http import urlquote
 
-import conf
-from utils import is_fb_logged_in
+from registry import get_current_app
+from utils import get_canvas_data, is_fb_logged_in
 
 
 def canvas_only(function=None):
@@ -17,27 +18,31 @@ def canvas_only(function=None):
     Decorator ensures that a page is only accessed from within a facebook
     application.
 
+    The verified data of the signed_request is available to the view as
+    ``request.facebook.canvas``, when the facebook middleware is installed.
     """
     def _dec(view_func):
         def _view(request, *args, **kwargs):
+            # Parse the request and ensure it's valid
+            try:
+                data = get_canvas_data(request)
+            except ValueError as e:
+                return HttpResponseBadRequest('<h1>400 Bad Request</h1>'
+                                              '<p>Invalid <em>signed_request'
+                                              '</em>: %s.</p>' % escape(e))
             # Make sure we're receiving a signed_request from facebook
-            if not request.POST.get('signed_request'):
+            if data is None:
                 return HttpResponseBadRequest('<h1>400 Bad Request</h1>'
                                     '<p>Missing <em>signed_request</em>.</p>')
-
-            # Parse the request and ensure it's valid
-            signed_request = request.POST["signed_request"]
-            data = conf.auth.parse_signed_request(signed_request)
-            if data is False:
-                return HttpResponseBadRequest('<h1>400 Bad Request</h1>'
-                                  '<p>Malformed <em>signed_request</em>.</p>')
+            if hasattr(request, 'facebook'):
+                request.facebook.canvas = data
 
             # If the user has not authorised redirect them
-            if not data.get('uid'):
+            if not data.get('user_id'):
                 scope = getattr(settings, 'FACEBOOK_PERMS', None)
-                auth_url = conf.auth.auth_url(conf.APP_ID,
-                                              conf.CANVAS_PAGE,
-                                              scope)
+                app = get_current_app()
+                auth_url = app.auth.get_auth_url(perms=scope,
+                                                 redirect_uri=app.canvas_page)
                 markup = ('<script type="text/javascript">'
                           'top.location.href="%s"</script>' % auth_url)
                 return HttpResponse(markup)
@@ -0,0 +1,192 @@
+"""
+Sending ``facebook_user_created`` outside of the login request.
+
+With FACEBOOK_USER_CREATED_DISPATCH set to ``'celery'`` or ``'thread'``, new
+users are queued once the transaction that created them commits. Queued users
+are sent to a celery task or a thread pool in batches, where
+``facebook_user_created`` is sent for each of them, with the user loaded from
+the database and the access_token read from the cache. Only the primary key,
+facebook id and app name of the users are queued, so the batches can go over
+the celery broker.
+
+Django < 1.9 can't tell when the transaction commits, so users are queued
+right away there, and users that aren't committed yet when their batch is
+sent are queued again, at most ``MAX_TRIES`` times.
+"""
+import atexit
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+import conf
+from .registry import get_current_app, override
+from .signals import facebook_user_created
+from .utils import get_cached_access_tokens
+
+log = logging.getLogger('django_facebook.dispatch')
+
+# How many times users that weren't found are queued again on Django < 1.9
+MAX_TRIES = 5
+
+
+def send_users_created(users):
+    """
+    Send ``facebook_user_created`` for the queued users, a list of dicts with
+    the ``pk``, ``fb_id`` and ``app`` of each user.
+
+    Returns the users to queue again, because they may not be committed yet.
+    """
+    from .auth import FacebookModelBackend
+    User = get_user_model()
+    by_app = {}
+    for user in users:
+        by_app.setdefault(user['app'], []).append(user)
+    retry = []
+    for app, users in by_app.items():
+        with override(app):
+            objects = User.objects.in_bulk([u['pk'] for u in users])
+            tokens = get_cached_access_tokens([u['fb_id'] for u in users])
+            for user in users:
+                if user['pk'] not in objects:
+                    retry.extend(_retry(user))
+                    continue
+                facebook_user_created.send_robust(
+                    sender=FacebookModelBackend, user=objects[user['pk']],
+                    access_token=tokens.get(user['fb_id']))
+    return retry
+
+
+def _retry(user):
+    if hasattr(transaction, 'on_commit'):
+        # Queued after the commit, so rolled back or deleted since
+        return []
+    tries = user.get('tries', 0) + 1
+    if tries >= MAX_TRIES:
+        log.warning('Not sending facebook_user_created for user %s, it was '
+                    'not found' % user['pk'])
+        return []
+    return [dict(user, tries=tries)]
+
+
+def _send_in_thread(users):
+    try:
+        for user in send_users_created(users):
+            get_queue().add(user)
+    except Exception:
+        log.exception('Sending facebook_user_created failed')
+    finally:
+        # Don't leave a connection open for every thread of the pool
+        connection.close()
+
+
+def _send_with_celery(users):
+    from .tasks import send_users_created as task
+    task.delay(users)
+
+
+class UserCreatedQueue(object):
+    """
+    Collects created users, and hands them to ``send`` in batches of at most
+    ``batch_size`` users, after at most ``interval`` seconds.
+    """
+
+    def __init__(self, send, batch_size, interval):
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self._users = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, user):
+        with self._lock:
+            self._users.append(user)
+            if len(self._users) < self.batch_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self, send=None):
+        """Hand the queued users to ``send``, or the ``send`` of the queue."""
+        with self._lock:
+            users, self._users = self._users, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if users:
+            log.debug('Sending facebook_user_created for %s users'
+                      % len(users))
+            (send or self.send)(users)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+_pool = None
+
+
+def get_queue():
+    """
+    Return the queue for FACEBOOK_USER_CREATED_DISPATCH of this process.
+    """
+    global _pool
+    # Threads and thread pools don't survive a fork
+    pid = os.getpid()
+    queue = _queues.get(pid)
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get(pid)
+            if queue is None:
+                if conf.USER_CREATED_DISPATCH == 'thread':
+                    pool = _pool = ThreadPool(2)
+                    send = lambda users: pool.apply_async(_send_in_thread,
+                                                          (users,))
+                else:
+                    send = _send_with_celery
+                queue = UserCreatedQueue(send, conf.USER_CREATED_BATCH_SIZE,
+                                         conf.USER_CREATED_BATCH_INTERVAL)
+                _queues.clear()
+                _queues[pid] = queue
+    return queue
+
+
+@atexit.register
+def _flush_on_exit():
+    queue = _queues.get(os.getpid())
+    if queue is None:
+        return
+    if conf.USER_CREATED_DISPATCH == 'thread':
+        # The pool's threads are daemons, they don't get to run anymore
+        _pool.close()
+        _pool.join()
+        queue.flush(_send_in_thread)
+        # Users that weren't committed yet won't be anymore
+        queue.flush(lambda users: None)
+    else:
+        queue.flush()
+
+
+def user_created(sender, user, access_token=None):
+    """
+    Send ``facebook_user_created`` for the new user, right away or queued,
+    depending on FACEBOOK_USER_CREATED_DISPATCH.
+    """
+    if conf.USER_CREATED_DISPATCH == 'sync':
+        facebook_user_created.send_robust(sender=sender, user=user,
+                                          access_token=access_token)
+        return
+
+    data = {'pk': user.pk, 'fb_id': user.get_username(),
+            'app': get_current_app().name}
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        # Django < 1.9 can't wait for the commit, see _retry
+        get_queue().add(data)
+    else:
+        on_commit(lambda: get_queue().add(data))
@@ -0,0 +1,105 @@
+"""
+Storing the friends of facebook users in the database, see ``Friendship``.
+
+``store_friends`` fetches the friends of a user and saves them, only adding
+and removing the friendships that changed since the last time. The other
+functions answer questions about the stored friends without calling
+facebook.
+"""
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+
+from .graph import get_graph_api
+from .models import Friendship
+from .sync import iter_connection
+
+User = get_user_model()
+
+log = logging.getLogger('django_facebook.friends')
+
+# Stay below the number of query parameters every database accepts
+DELETE_CHUNK_SIZE = 500
+
+
+def get_friend_ids(fb_id):
+    """Return the set of facebook ids of the stored friends of a user."""
+    return set(Friendship.objects.filter(fb_id=fb_id)
+               .values_list('friend_fb_id', flat=True))
+
+
+def save_friends(fb_id, friend_ids):
+    """
+    Make ``friend_ids`` the stored friends of the user with ``fb_id``. Only
+    new friends are inserted, with a single ``bulk_create``, and only former
+    friends are deleted. Returns the sets of added and removed friend ids.
+    """
+    friend_ids = set(str(i) for i in friend_ids)
+    try:
+        with transaction.atomic():
+            return _save_friends(fb_id, friend_ids)
+    except IntegrityError:
+        # Friends of the same user were saved concurrently, diff again
+        with transaction.atomic():
+            return _save_friends(fb_id, friend_ids)
+
+
+def _save_friends(fb_id, friend_ids):
+    existing = get_friend_ids(fb_id)
+    added = friend_ids - existing
+    removed = existing - friend_ids
+    if added:
+        Friendship.objects.bulk_create([
+            Friendship(fb_id=fb_id, friend_fb_id=friend_id)
+            for friend_id in added])
+    removed_list = list(removed)
+    for i in range(0, len(removed_list), DELETE_CHUNK_SIZE):
+        Friendship.objects.filter(
+            fb_id=fb_id,
+            friend_fb_id__in=removed_list[i:i + DELETE_CHUNK_SIZE]).delete()
+    log.debug('Friends of %s: %s added, %s removed'
+              % (fb_id, len(added), len(removed)))
+    return added, removed
+
+
+def store_friends(fb_id, access_token=None, graph=None, page_size=500):
+    """
+    Fetch the friends of a user from facebook and save them, see
+    ``save_friends``. Only the ids of the friends are requested. Pass
+    ``graph`` to use that instead of a paced ``PooledGraphAPI`` for the
+    access_token.
+    """
+    graph = graph or get_graph_api(access_token, user_id=fb_id, paced=True)
+    friends = iter_connection(graph, 'me', 'friends', page_size=page_size,
+                              fields='id')
+    return save_friends(fb_id, [friend['id'] for friend in friends])
+
+
+def delete_friends(fb_ids):
+    """Delete the stored friends of the users, when they leave the app."""
+    Friendship.objects.filter(fb_id__in=list(fb_ids)).delete()
+
+
+def are_friends(fb_id, other_fb_id):
+    return Friendship.objects.filter(fb_id=fb_id,
+                                     friend_fb_id=other_fb_id).exists()
+
+
+def friends_using_app(fb_id):
+    """
+    Return a queryset of the users that are stored friends of the user with
+    ``fb_id``, in a single query.
+    """
+    friend_ids = Friendship.objects.filter(fb_id=fb_id) \
+        .values('friend_fb_id')
+    return User.objects.filter(**{User.USERNAME_FIELD + '__in': friend_ids})
+
+
+def mutual_friend_ids(fb_id, other_fb_id):
+    """Return the set of facebook ids of the friends two users share."""
+    other_friends = Friendship.objects.filter(fb_id=other_fb_id) \
+        .values('friend_fb_id')
+    return set(Friendship.objects.filter(fb_id=fb_id,
+                                         friend_fb_id__in=other_friends)
+               .values_list('friend_fb_id', flat=True))
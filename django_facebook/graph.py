@@ -0,0 +1,298 @@
+"""
+Helpers around ``facebook.GraphAPI``.
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import facebook
+import requests
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import urlencode
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import conf
+from .ratelimit import limiter
+from .registry import get_current_app
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+log = logging.getLogger('django_facebook.graph')
+
+_transport_lock = threading.Lock()
+_transports = {}
+
+
+def get_session(retry_sent=True):
+    """
+    Return the ``requests.Session`` this process uses for calls to facebook.
+    It keeps up to FACEBOOK_HTTP_POOL_SIZE connections per host alive, and
+    retries idempotent requests that failed to connect or got a 5xx answer up
+    to FACEBOOK_HTTP_RETRIES times, with exponential backoff. The last 5xx
+    answer is returned rather than raised, so it ends up as a
+    ``facebook.GraphAPIError``.
+
+    With ``retry_sent=False`` only requests that failed to connect are
+    retried, not those facebook may have handled, for calls that must not be
+    made twice (like exchanging a code).
+
+    Calls never wait for a pooled connection, that wait would not be bounded
+    by FACEBOOK_TIMEOUT. When all are in use an extra connection is opened,
+    which is closed after the call.
+    """
+    # Sessions must not be shared with forked children (like celery workers),
+    # as they would share the sockets.
+    key = (os.getpid(), retry_sent)
+    session = _transports.get(key)
+    if session is None:
+        with _transport_lock:
+            session = _transports.get(key)
+            if session is None:
+                if retry_sent:
+                    retry = Retry(total=conf.HTTP_RETRIES,
+                                  backoff_factor=conf.HTTP_BACKOFF,
+                                  status_forcelist=(500, 502, 503, 504),
+                                  raise_on_status=False)
+                else:
+                    retry = Retry(total=conf.HTTP_RETRIES, read=0,
+                                  backoff_factor=conf.HTTP_BACKOFF)
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=conf.HTTP_POOL_HOSTS,
+                    pool_maxsize=conf.HTTP_POOL_SIZE,
+                    pool_block=False,
+                    max_retries=retry)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                for other in list(_transports):
+                    if other[0] != key[0]:
+                        del _transports[other]
+                _transports[key] = session
+    return session
+
+
+def get_session_stats():
+    """
+    Return the usage of the connection pools of the session, per host.
+    """
+    stats = {}
+    for adapter in set(get_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['%s:%s' % (pool.host, pool.port)] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                # the pool's queue is padded with None for unopened slots
+                'idle': len([c for c in list(pool.pool.queue) if c])
+                if pool.pool else 0,
+                'max_size': conf.HTTP_POOL_SIZE,
+            }
+    return stats
+
+
+class PooledGraphAPI(facebook.GraphAPI):
+    """
+    ``facebook.GraphAPI`` that does its requests over a shared, pooled
+    session (see ``get_session``) instead of opening new connections for every
+    call. Calls go to FACEBOOK_GRAPH_URL.
+
+    Rate limit usage is reported to ``ratelimit.limiter``, for the facebook
+    user ``user_id`` if given. With ``paced=True`` every call waits until the
+    limiter allows it, which is meant for background work, or raises
+    ``ratelimit.RateLimited`` when that takes too long.
+    """
+
+    def __init__(self, access_token=None, timeout=None, version="2.2",
+                 session=None, user_id=None, paced=False):
+        super(PooledGraphAPI, self).__init__(access_token, timeout, version)
+        self.session = session or get_session()
+        self.url = '%s%s/' % (conf.GRAPH_URL, self.version)
+        self.user_id = user_id
+        self.paced = paced
+
+    def get_objects(self, ids, **args):
+        # facebook.GraphAPI passes the args as the path
+        args['ids'] = ','.join(ids)
+        return self.request('', args)
+
+    def request(self, path, args=None, post_args=None, files=None,
+                method=None):
+        args = args or {}
+        if self.access_token:
+            if post_args is not None:
+                post_args["access_token"] = self.access_token
+            else:
+                args["access_token"] = self.access_token
+        return self.bare_request(self.url + path, args, post_args, files,
+                                 method)
+
+    def bare_request(self, url, args=None, post_args=None, files=None,
+                     method=None):
+        if self.paced:
+            limiter.pace(self.user_id)
+        response = self.session.request(method or "GET", url,
+                                        timeout=self.timeout,
+                                        params=args,
+                                        data=post_args,
+                                        files=files)
+        limiter.update(response.headers, self.user_id)
+        try:
+            return self.parse_response(response)
+        except facebook.GraphAPIError as e:
+            limiter.record_error(e, self.user_id)
+            raise
+
+    def parse_response(self, response):
+        """
+        Turn the response into a result, the same way
+        ``facebook.GraphAPI.bare_request`` does.
+        """
+        content_type = response.headers.get('content-type', '')
+        if 'json' in content_type:
+            result = response.json()
+        elif 'image/' in content_type:
+            result = {"data": response.content,
+                      "mime-type": content_type,
+                      "url": response.url}
+        else:
+            query_str = parse_qs(response.text)
+            if "access_token" not in query_str:
+                raise facebook.GraphAPIError('Maintype was not text, image, '
+                                             'or querystring')
+            result = {"access_token": query_str["access_token"][0]}
+            if "expires" in query_str:
+                result["expires"] = query_str["expires"][0]
+
+        if result and isinstance(result, dict) and result.get("error"):
+            raise facebook.GraphAPIError(result)
+        return result
+
+
+def get_graph_api(access_token=None, session=None, user_id=None,
+                  paced=False):
+    """
+    Return a ``PooledGraphAPI`` for the configured api version, that gives up
+    on facebook after FACEBOOK_TIMEOUT seconds. Pass a ``requests.Session``
+    to use that instead of the shared one.
+    """
+    return PooledGraphAPI(access_token, timeout=conf.TIMEOUT,
+                          version=conf.VERSION, session=session,
+                          user_id=user_id, paced=paced)
+
+
+def get_access_token_from_code(code, redirect_uri=None):
+    """
+    Exchange the code for an access_token of the active app, like
+    ``facebook.Auth.get_access_token_from_code``, but with FACEBOOK_TIMEOUT.
+
+    Returns a dict with the access_token and the seconds it expires in.
+    """
+    app = get_current_app()
+    if redirect_uri is None:
+        redirect_uri = app.auth.redirect_uri
+    # A code can be used only once, a retry could only fail
+    graph = get_graph_api(session=get_session(retry_sent=False))
+    return graph.request('oauth/access_token', {
+        'code': code,
+        'redirect_uri': redirect_uri,
+        'client_id': app.app_id,
+        'client_secret': app.app_secret,
+    })
+
+
+class BatchGraphAPI(object):
+    """
+    Graph API reader that queues calls, and sends them to facebook as a single
+    batch request the first time one of the results is used.
+
+    The read methods mirror those of ``facebook.GraphAPI``, but return lazy
+    objects instead of the data itself. Identical calls are only done once.
+    When facebook returned an error for a call, a ``facebook.GraphAPIError``
+    is raised upon using its result::
+
+        me = request.facebook.batch.get_object('me')
+        friends = request.facebook.batch.get_connections('me', 'friends')
+        # Both are fetched in one request here
+        name = me['name']
+    """
+    # Facebook doesn't accept more than 50 calls in one batch
+    max_batch_size = 50
+
+    def __init__(self, graph, url=None):
+        self.graph = graph
+        self.url = url or '%s%s/' % (conf.GRAPH_URL, graph.version)
+        self._calls = OrderedDict()
+        self._results = {}
+
+    def get_object(self, id, **args):
+        return self._queue(id, args)
+
+    def get_objects(self, ids, **args):
+        args['ids'] = ','.join(ids)
+        return self._queue('', args)
+
+    def get_connections(self, id, connection_name, **args):
+        return self._queue('%s/%s' % (id, connection_name), args)
+
+    def _queue(self, path, args):
+        relative_url = path
+        if args:
+            relative_url += '?' + urlencode(sorted(args.items()))
+        if relative_url not in self._calls:
+            self._calls[relative_url] = SimpleLazyObject(
+                lambda: self._get_result(relative_url))
+        return self._calls[relative_url]
+
+    def _get_result(self, relative_url):
+        if relative_url not in self._results:
+            self.flush()
+        result = self._results[relative_url]
+        if isinstance(result, facebook.GraphAPIError):
+            raise result
+        return result
+
+    def flush(self):
+        """
+        Send all calls that haven't been done yet to facebook.
+        """
+        pending = [u for u in self._calls if u not in self._results]
+        for i in range(0, len(pending), self.max_batch_size):
+            chunk = pending[i:i + self.max_batch_size]
+            batch = [{'method': 'GET', 'relative_url': u} for u in chunk]
+            post_args = {'batch': json.dumps(batch)}
+            if self.graph.access_token:
+                post_args['access_token'] = self.graph.access_token
+            log.debug('Sending batch of %d graph calls' % len(chunk))
+            try:
+                responses = self.graph.bare_request(self.url,
+                                                    post_args=post_args,
+                                                    method='POST')
+            except facebook.GraphAPIError as e:
+                responses = [e] * len(chunk)
+            for relative_url, response in zip(chunk, responses):
+                self._results[relative_url] = self._parse_response(response)
+
+    def _parse_response(self, response):
+        if isinstance(response, facebook.GraphAPIError):
+            return response
+        if response is None:
+            # Facebook returns null for calls that timed out
+            return facebook.GraphAPIError('Batched graph call timed out')
+        try:
+            body = json.loads(response['body'])
+        except (KeyError, TypeError, ValueError):
+            return facebook.GraphAPIError('Invalid batch response: %r'
+                                          % response)
+        if response.get('code') != 200 or \
+                (isinstance(body, dict) and body.get('error')):
+            return facebook.GraphAPIError(body)
+        return body
@@ -0,0 +1,55 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from django_facebook.provision import UserImport, iter_ids
+from django_facebook.registry import override
+
+
+class Command(BaseCommand):
+    help = ('Create users for the facebook ids in a file, one id per line. '
+            'Users that already exist are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="file with the facebook ids, or '-' "
+                                         "for stdin")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='number of users to create at once')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='number of ids to skip, to resume an '
+                                 'interrupted import')
+        parser.add_argument('--prefetch-profiles', action='store_true',
+                            help='fetch and cache the profiles of new users')
+        parser.add_argument('--no-signals', action='store_false',
+                            dest='send_signals',
+                            help="don't send facebook_users_created and "
+                                 "facebook_user_created")
+        parser.add_argument('--app', help='name of the facebook app in '
+                                          'FACEBOOK_APPS to import for')
+
+    def handle(self, path, **options):
+        self.handled = options['offset']
+
+        def progress(handled, created):
+            self.handled = handled
+            self.stdout.write('%s ids handled, %s users created'
+                              % (handled, created))
+
+        importer = UserImport(chunk_size=options['chunk_size'],
+                              prefetch_profiles=options['prefetch_profiles'],
+                              send_signals=options['send_signals'],
+                              progress=progress)
+        f = sys.stdin if path == '-' else open(path)
+        try:
+            with override(options['app']):
+                handled, created = importer.run(iter_ids(f),
+                                                options['offset'])
+        except BaseException:
+            self.stderr.write('Import stopped, resume it with --offset %s'
+                              % self.handled)
+            raise
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        self.stdout.write('Done, %s ids handled, %s users created'
+                          % (handled, created))
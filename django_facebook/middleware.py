@@ -1,15 +1,20 @@
 import hashlib
 import logging
 
-import facebook
-from django.contrib.auth import authenticate
-from django.core.cache import cache
+from django.contrib.auth import authenticate, BACKEND_SESSION_KEY
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
 
 import conf
-from .auth import login, logout
-from .utils import (FB_DATA_CACHE_KEY, get_lazy_access_token,
-                    get_signed_request_data, is_fb_logged_in)
+from . import stats
+from .auth import get_stateless_user, login, logout
+from .graph import BatchGraphAPI, get_graph_api
+from .profile import FacebookProfile
+from .registry import activate_for_request
+from .sync import iter_connection
+from .utils import (FACEBOOK_BACKEND, get_cached_fb_user_data,
+                    get_lazy_access_token, get_signed_request_data,
+                    is_fb_logged_in)
 
 log = logging.getLogger('django_facebook.middleware')
 
@@ -18,18 +23,81 @@ class FacebookAccessor(object):
     """
     Simple accessor object for the Facebook user. Non-existing properties
     will return None instead of raising a AttributeError.
-    """
 
-    def __init__(self, request):
-        self.auth = conf.auth
-        if is_fb_logged_in(request):
-            self.user_id = request.user.get_username()
-            self.access_token = get_lazy_access_token(request)
-            self.graph = facebook.GraphAPI(self.access_token)
+    Nothing is worked out until ``user_id``, ``access_token``, ``graph``,
+    ``batch`` or ``profile`` is first read, so requests that don't use
+    facebook don't load the user, parse the cookie or create graph objects.
+    Values that are set on the accessor before that are kept.
+
+    With ``use_cached_data`` set (see ``FacebookCacheMiddleware``), other
+    attributes are looked up in the cached user data.
+
+    Pass ``logged_in`` if you already know whether the user is logged in with
+    facebook, and ``user_id`` if you know their facebook id, to save the
+    lookups.
+
+    ``app`` is the facebook app of the request (see ``registry``), ``auth``
+    its ``facebook.Auth``.
+    """
+    lazy_attributes = ('user_id', 'access_token', 'graph', 'batch', 'profile')
+    use_cached_data = False
+
+    def __init__(self, request, logged_in=None, user_id=None):
+        self.app = activate_for_request(request)
+        self.auth = self.app.auth
+        self._request = request
+        self._logged_in = logged_in
+        self._user_id = user_id
+        self._set_up = False
+        self._cached_data = None
+
+    def _setup(self):
+        self._set_up = True
+        attrs = self.__dict__
+        logged_in = self._logged_in
+        if logged_in is None and 'user_id' not in attrs:
+            logged_in = is_fb_logged_in(self._request)
+        if not logged_in and 'user_id' not in attrs:
+            return
+        if 'user_id' not in attrs:
+            attrs['user_id'] = (self._user_id or
+                                self._request.user.get_username())
+        if 'access_token' not in attrs:
+            attrs['access_token'] = get_lazy_access_token(self._request,
+                                                          attrs['user_id'])
+        attrs.setdefault('graph', get_graph_api(attrs['access_token']))
+        attrs.setdefault('batch', BatchGraphAPI(attrs['graph']))
+        attrs.setdefault('profile', FacebookProfile(attrs['user_id'],
+                                                    attrs['graph']))
 
     def __getattr__(self, name):
+        if name.startswith('_'):
+            return None
+        if name in self.lazy_attributes:
+            if not self._set_up:
+                self._setup()
+                return self.__dict__.get(name)
+        elif self.use_cached_data and self.user_id:
+            if self._cached_data is None:
+                self._cached_data = get_cached_fb_user_data(self.user_id) or {}
+                stats.incr('user_data_cache.hit' if self._cached_data
+                           else 'user_data_cache.miss')
+            return self._cached_data.get(name)
         return None
 
+    def iter_connection(self, connection_name, id='me', page_size=None,
+                        fields=None, prefetch=True):
+        """
+        Iterate over the items of a connection of the user, or of the object
+        with ``id``, across all its pages. See ``sync.iter_connection``.
+        Yields nothing when the user isn't logged in with facebook.
+        """
+        if self.graph is None:
+            return iter(())
+        return iter_connection(self.graph, id, connection_name,
+                               page_size=page_size, fields=fields,
+                               prefetch=prefetch)
+
 
 class FacebookLoginMiddleware(object):
     """
@@ -56,7 +124,8 @@ class FacebookLoginMiddleware(object):
                 " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
                 " before the FacebookLoginMiddleware class.")
 
-        if request.user.is_anonymous() and conf.COOKIE_NAME in request.COOKIES:
+        app = activate_for_request(request)
+        if request.user.is_anonymous() and app.cookie_name in request.COOKIES:
             user = authenticate(request=request,
                                 force_validate=self.force_validate)
             if user:
@@ -83,9 +152,10 @@ class FacebookLogOutMiddleware(object):
                 " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
                 " before the FacebookLogOutMiddleware class.")
 
+        app = activate_for_request(request)
         if is_fb_logged_in(request):
 
-            if not request.COOKIES.get(conf.COOKIE_NAME):
+            if not request.COOKIES.get(app.cookie_name):
                 logout(request)
                 log.debug('User logged out, no fbsr_ cookie found')
                 return
@@ -109,18 +179,15 @@ class FacebookHelperMiddleware(object):
 
 class FacebookCacheMiddleware(object):
     """
-    This middleware loads tries to load user data from the cache. If found, it
-    populates request.facebook with it.
+    This middleware makes request.facebook look up attributes it doesn't have
+    in the cached user data (see ``utils.cache_fb_user_data``). The cache is
+    only read when such an attribute is first used.
 
     This middleware MUST come after the FacebookHelperMiddleware!
     """
 
     def process_request(self, request):
-        if request.facebook.user_id:
-            fb_data = cache.get(FB_DATA_CACHE_KEY % request.facebook.user_id)
-            if fb_data:
-                for k, v in fb_data.iteritems():
-                    setattr(request.facebook, k, v)
+        request.facebook.use_cached_data = True
 
 
 class FacebookMiddleware(object):
@@ -130,11 +197,106 @@ class FacebookMiddleware(object):
     - Log someone in if we can authenticate them (see ``auth``)
     - Log someone out if we can't authenticate them anymore
     - Add a ``facebook`` attribute to the request with a graph accessor.
+
+    It does the work of the logout, login and helper middlewares in a single
+    pass, and skips all of it when there is neither a ``fbsr_`` cookie nor a
+    facebook login in the session. It can be used both in ``MIDDLEWARE`` and
+    in ``MIDDLEWARE_CLASSES``.
+
+    With FACEBOOK_STATELESS on, the user is not logged in to the session.
+    Instead ``request.user`` is set to a lazily loaded user for the verified
+    ``fbsr_`` cookie on every request, so the session isn't read or written
+    for facebook users.
+    """
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.process_request(request)
+        return response or self.get_response(request)
+
+    def process_request(self, request):
+        # AuthenticationMiddleware is required so that request.user exists.
+        if not hasattr(request, 'user'):
+            raise ImproperlyConfigured(
+                "The FacebookMiddleware requires the"
+                " authentication middleware to be installed. Edit your"
+                " MIDDLEWARE_CLASSES setting and insert"
+                " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
+                " before the FacebookMiddleware class.")
+
+        app = activate_for_request(request)
+        cookie = request.COOKIES.get(app.cookie_name)
+        if conf.STATELESS:
+            self.process_stateless(request, cookie)
+            return
+
+        logged_in = request.session.get(BACKEND_SESSION_KEY) == FACEBOOK_BACKEND
+        if not cookie and not logged_in:
+            # Anonymous as far as facebook is concerned, nothing to do
+            request.facebook = FacebookAccessor(request, logged_in=False)
+            return
+
+        logged_in = logged_in and request.user.is_authenticated()
+        if logged_in:
+            if not cookie:
+                logout(request)
+                logged_in = False
+                log.debug('User logged out, no fbsr_ cookie found')
+            else:
+                data = get_signed_request_data(request)
+                if data and data['user_id'] != request.user.get_username():
+                    # Also logout if the fb session changes
+                    logout(request)
+                    logged_in = False
+                    log.debug('User logged out. User_id on server differs '
+                              'from client side')
+
+        # logout() removes the cookie, so check the request again
+        if (not logged_in and app.cookie_name in request.COOKIES
+                and request.user.is_anonymous()):
+            user = authenticate(request=request)
+            if user:
+                login(request, user)
+                logged_in = True
+
+        request.facebook = FacebookAccessor(request, logged_in=logged_in)
+
+    def process_stateless(self, request, cookie):
+        user_id = None
+        if cookie:
+            user_id = get_signed_request_data(request).get('user_id')
+        if user_id:
+            request.user = SimpleLazyObject(
+                lambda: get_stateless_user(user_id))
+        request.facebook = FacebookAccessor(request, logged_in=bool(user_id),
+                                            user_id=user_id)
+
+
+class FacebookStatsMiddleware(object):
+    """
+    Logs a summary of the facebook metrics (see ``stats``) of every request
+    that had any to the ``django_facebook.stats`` logger. Put it at the top of
+    your middleware.
     """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
     def process_request(self, request):
-        FacebookHelperMiddleware().process_request(request)
-        FacebookLogOutMiddleware().process_request(request)
-        FacebookLoginMiddleware().process_request(request)
+        stats.start_request()
+
+    def process_response(self, request, response):
+        summary = stats.end_request()
+        if summary:
+            stats.log.info('facebook stats for %s: %s' % (
+                request.path, ' '.join('%s=%g' % (k, v)
+                                       for k, v in sorted(summary.items()))))
+        return response
 
 
 class FacebookDebugCanvasMiddleware(object):
@@ -167,7 +329,8 @@ class FacebookDebugCookieMiddleware(object):
     """
 
     def process_request(self, request):
-        request.COOKIES[conf.COOKIE_NAME] = conf.DEBUG_COOKIE
+        request.COOKIES[activate_for_request(request).cookie_name] = \
+            conf.DEBUG_COOKIE
         return None
 
 
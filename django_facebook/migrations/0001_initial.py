@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('fb_id', models.CharField(max_length=32)),
+                ('friend_fb_id', models.CharField(max_length=32, db_index=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='friendship',
+            unique_together=set([('fb_id', 'friend_fb_id')]),
+        ),
+    ]
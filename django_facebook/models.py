@@ -0,0 +1,18 @@
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+
+
+@python_2_unicode_compatible
+class Friendship(models.Model):
+    """
+    A facebook user and one of their friends, by facebook id, as last synced
+    by ``friends.store_friends``. Friends don't need to have a user.
+    """
+    fb_id = models.CharField(max_length=32)
+    friend_fb_id = models.CharField(max_length=32, db_index=True)
+
+    class Meta:
+        unique_together = ('fb_id', 'friend_fb_id')
+
+    def __str__(self):
+        return '%s - %s' % (self.fb_id, self.friend_fb_id)
@@ -0,0 +1,113 @@
+"""
+Cached facebook profile data, with declared fields that each have their own
+time to live.
+"""
+import json
+import logging
+import time
+
+import conf
+from .store import store
+from .utils import FB_PROFILE_CACHE_KEY
+
+log = logging.getLogger('django_facebook.profile')
+
+
+class FacebookProfile(object):
+    """
+    Lazy, attribute based access to the profile of a facebook user::
+
+        request.facebook.profile.name
+
+    Only the fields declared in FACEBOOK_PROFILE_FIELDS (a dict mapping field
+    names to the seconds they may be cached, or None for no limit) can be
+    read. The cache is read on the first access. When a field that is read is
+    missing or stale, all missing and stale fields are fetched in a single
+    Graph call asking for just those fields.
+    """
+
+    def __init__(self, user_id, graph, fields=None):
+        self.user_id = user_id
+        self.graph = graph
+        self.fields = conf.PROFILE_FIELDS if fields is None else fields
+        self._values = None
+        self._fetched = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.fields:
+            raise AttributeError(name)
+        if self._values is None:
+            self._load()
+        if name in self.stale_fields():
+            self.refresh()
+        return self._values.get(name)
+
+    def _load(self):
+        self._values, self._fetched = {}, {}
+        data = store.get(FB_PROFILE_CACHE_KEY % self.user_id)
+        if data:
+            data = json.loads(data)
+            self._values, self._fetched = data['v'], data['t']
+
+    def _save(self):
+        store.set(FB_PROFILE_CACHE_KEY % self.user_id,
+                  _dump(self._values, self._fetched), _timeout(self.fields))
+
+    def stale_fields(self):
+        """Return the declared fields that are missing or expired."""
+        if self._values is None:
+            self._load()
+        now = time.time()
+        return set(field for field, ttl in self.fields.items()
+                   if field not in self._fetched or
+                   (ttl and self._fetched[field] + ttl < now))
+
+    def refresh(self, fields=None):
+        """
+        Fetch ``fields``, or all missing and stale fields, from facebook in
+        one call and cache them.
+        """
+        if self._values is None:
+            self._load()
+        if fields is None:
+            fields = self.stale_fields()
+        if not fields:
+            return
+        log.debug('Fetching %s for %s' % (', '.join(sorted(fields)),
+                                         self.user_id))
+        data = self.graph.get_object(self.user_id,
+                                     fields=','.join(sorted(fields)))
+        now = int(time.time())
+        for field in fields:
+            # Store fields facebook didn't return too, so we don't keep
+            # asking for fields the user didn't give us permission for.
+            self._values[field] = data.get(field)
+            self._fetched[field] = now
+        self._save()
+
+
+def _dump(values, fetched):
+    return json.dumps({'v': values, 't': fetched}, separators=(',', ':'))
+
+
+def _timeout(fields):
+    """The cache timeout of a profile, which is the longest ttl of a field."""
+    ttls = [ttl for ttl in fields.values() if ttl]
+    return max(ttls) if len(ttls) == len(fields) else None
+
+
+def cache_profiles(profiles, fields=None):
+    """
+    Cache the profiles of many users at once, for example fetched with a
+    single ``get_objects`` call. ``profiles`` maps facebook ids to the data
+    facebook returned for the declared ``fields``.
+    """
+    fields = conf.PROFILE_FIELDS if fields is None else fields
+    now = int(time.time())
+    data = {}
+    for user_id, profile in profiles.items():
+        values = dict((field, profile.get(field)) for field in fields)
+        data[FB_PROFILE_CACHE_KEY % user_id] = _dump(
+            values, dict.fromkeys(fields, now))
+    if data:
+        store.set_many(data, _timeout(fields))
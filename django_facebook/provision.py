@@ -0,0 +1,141 @@
+"""
+Creating users for many facebook ids at once, for imports and migrations.
+"""
+import itertools
+import logging
+import time
+
+import facebook
+import requests
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+
+import conf
+from .dispatch import user_created
+from .graph import get_graph_api
+from .profile import cache_profiles
+from .ratelimit import RateLimited
+from .registry import get_current_app
+from .signals import facebook_users_created
+
+User = get_user_model()
+
+log = logging.getLogger('django_facebook.provision')
+
+
+def iter_ids(lines):
+    """
+    Yield the facebook ids in ``lines``, like an open file with an id on every
+    line. Empty lines and lines starting with ``#`` are skipped.
+    """
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+class UserImport(object):
+    """
+    Creates the users that don't exist yet for a stream of facebook ids, with
+    a ``bulk_create`` for every ``chunk_size`` ids. Users get an unusable
+    password, like the ones ``FacebookModelBackend`` creates.
+
+    For every chunk with new users the ``facebook_users_created`` signal is
+    sent once, with the list of new users, and ``facebook_user_created`` for
+    every new user, like for users created at login (see ``dispatch``),
+    unless ``send_signals`` is False.
+    With ``prefetch_profiles`` the FACEBOOK_PROFILE_FIELDS of the new users
+    are fetched with the app access_token and cached.
+
+    ``progress`` is called after every chunk with the number of ids handled so
+    far, which is the ``offset`` to pass to ``run`` to resume an interrupted
+    import, and the number of users created.
+    """
+    # Facebook doesn't accept more ids in one call
+    max_ids_per_call = 50
+
+    def __init__(self, chunk_size=1000, prefetch_profiles=False,
+                 send_signals=True, progress=None):
+        self.chunk_size = chunk_size
+        self.prefetch_profiles = prefetch_profiles
+        self.send_signals = send_signals
+        self.progress = progress
+
+    def run(self, ids, offset=0):
+        """
+        Import the facebook ids in the iterable ``ids``, skipping the first
+        ``offset``. Returns the number of ids handled and users created.
+        """
+        ids = iter(ids)
+        handled = offset
+        created = 0
+        for _ in itertools.islice(ids, offset):
+            pass
+        while True:
+            chunk = list(itertools.islice(ids, self.chunk_size))
+            if not chunk:
+                break
+            created += len(self.import_chunk(chunk))
+            handled += len(chunk)
+            if self.progress:
+                self.progress(handled, created)
+        return handled, created
+
+    def import_chunk(self, ids):
+        """Create the users for the facebook ids, returns the new users."""
+        ids = list(set(str(i) for i in ids))
+        try:
+            with transaction.atomic():
+                new_ids = self.create_users(ids)
+        except IntegrityError:
+            # Some users logged in while we were busy, try again without them
+            with transaction.atomic():
+                new_ids = self.create_users(ids)
+
+        users = []
+        if new_ids:
+            # bulk_create doesn't give us the primary keys on every database
+            users = list(User.objects.filter(
+                **{User.USERNAME_FIELD + '__in': new_ids}))
+            if self.prefetch_profiles:
+                self.fetch_profiles(new_ids)
+            if self.send_signals:
+                facebook_users_created.send_robust(sender=self.__class__,
+                                                   users=users)
+                for user in users:
+                    user_created(self.__class__, user)
+        log.debug('Created %s of %s users' % (len(users), len(ids)))
+        return users
+
+    def create_users(self, ids):
+        existing = set(User.objects.filter(
+            **{User.USERNAME_FIELD + '__in': ids}
+        ).values_list(User.USERNAME_FIELD, flat=True))
+        new_ids = [i for i in ids if i not in existing]
+        User.objects.bulk_create([User(**{User.USERNAME_FIELD: i,
+                                          'password': '!'})
+                                  for i in new_ids])
+        return new_ids
+
+    def fetch_profiles(self, ids):
+        app = get_current_app()
+        graph = get_graph_api('%s|%s' % (app.app_id, app.app_secret),
+                              paced=True)
+        fields = ','.join(sorted(conf.PROFILE_FIELDS))
+        for i in range(0, len(ids), self.max_ids_per_call):
+            chunk = ids[i:i + self.max_ids_per_call]
+            try:
+                profiles = self.get_profiles(graph, chunk, fields)
+            except (facebook.GraphAPIError, requests.RequestException) as e:
+                log.warning('Fetching profiles failed: %s' % e)
+                continue
+            cache_profiles(profiles)
+
+    def get_profiles(self, graph, ids, fields):
+        # Imports don't hold a request or a worker, so wait for the limits
+        while True:
+            try:
+                return graph.get_objects(ids, fields=fields)
+            except RateLimited as e:
+                log.info('Fetching profiles paused: %s' % e)
+                time.sleep(e.wait)
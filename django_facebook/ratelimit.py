@@ -0,0 +1,312 @@
+"""
+Pacing of Graph API calls, so background work uses as much of facebook's rate
+limits as it can without being throttled.
+
+Every ``graph.PooledGraphAPI`` reports the usage headers facebook sends
+(``X-App-Usage`` and ``X-Business-Use-Case-Usage``) and rate limit errors to
+``limiter``. Graph objects created with ``paced=True`` wait for a token of the
+app bucket and of the bucket of their user before every call, or raise
+``RateLimited`` when that takes more than ``FACEBOOK_RATE_LIMIT_MAX_WAIT``
+seconds. Web requests are never paced, but their usage reports slow down the
+background work.
+
+The buckets live in process memory, the usage headers are what keeps the
+processes of an app in line with each other. When a limit is reached the
+block is put in the store as well, so the other processes pause too.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import conf
+from . import stats
+from .registry import get_current_app
+from .store import store
+
+log = logging.getLogger('django_facebook.ratelimit')
+
+# Error codes of facebook for an exhausted app limit, and for exhausted user,
+# page and custom limits.
+APP_LIMIT_ERRORS = (4,)
+USER_LIMIT_ERRORS = (17, 32, 613)
+
+# Until when the app ('app') or a user is blocked, shared between processes
+RATE_LIMIT_BLOCK_CACHE_KEY = '_fb_ratelimit_blocked_%s'
+
+
+class RateLimited(Exception):
+    """
+    Raised by ``RateLimiter.pace`` instead of waiting ``wait`` seconds, which
+    is longer than the configured maximum.
+    """
+
+    def __init__(self, wait):
+        super(RateLimited, self).__init__(
+            'Facebook rate limit reached, retry in %.1fs' % wait)
+        self.wait = wait
+
+
+class TokenBucket(object):
+    """
+    Bucket that fills with ``rate`` tokens per second up to ``capacity``, or
+    never runs out when ``rate`` is None. It can be blocked until a timestamp,
+    for when facebook says the limit is reached. ``usage`` is the last usage
+    percentage facebook reported for it.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.base_rate = self.rate = rate
+        self.capacity = capacity or max(1, rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.usage = 0
+
+    def _tokens(self, now):
+        if not self.rate:
+            return self.tokens
+        return min(self.capacity,
+                   self.tokens + (now - self.updated) * self.rate)
+
+    def _refill(self, now):
+        self.tokens = self._tokens(now)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, without changing the bucket."""
+        wait = max(0, self.blocked_until - now)
+        tokens = self._tokens(now)
+        if self.rate and tokens < 1:
+            wait = max(wait, (1 - tokens) / self.rate)
+        return wait
+
+    def take(self, now):
+        """
+        Take a token, going into debt when there is none, and return the
+        seconds to wait before using it.
+        """
+        self._refill(now)
+        wait = self.wait_time(now)
+        if self.rate:
+            self.tokens -= 1
+        return wait
+
+    def state(self, now):
+        self._refill(now)
+        return {'rate': self.rate, 'tokens': round(self.tokens, 2),
+                'blocked_for': max(0, round(self.blocked_until - now, 1))}
+
+
+class RateLimiter(object):
+    """
+    A token bucket for every facebook app (see ``registry``), which is used
+    for the active app, and one for each user (at most ``max_users``, least
+    recently used ones are dropped).
+
+    ``pace`` sleeps for at most ``max_wait`` seconds, and raises
+    ``RateLimited`` when the wait would be longer, so the caller can postpone
+    the work instead of holding a worker.
+
+    When the app usage facebook reports goes over ``threshold`` percent, the
+    rate of the app bucket is lowered linearly, to nothing at 100%. When a
+    limit is reached the app or user is blocked for the time facebook says it
+    takes to regain access, or ``block_time`` seconds.
+    """
+
+    def __init__(self, app_rate, user_rate, threshold, block_time,
+                 max_wait=5, max_users=10000):
+        self.app_rate = app_rate
+        self.user_rate = user_rate
+        self.threshold = threshold
+        self.block_time = block_time
+        self.max_wait = max_wait
+        self.max_users = max_users
+        self._apps = {}
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def app(self):
+        """The bucket of the active app."""
+        app_id = get_current_app().app_id
+        bucket = self._apps.get(app_id)
+        if bucket is None:
+            bucket = self._apps[app_id] = TokenBucket(self.app_rate)
+        return bucket
+
+    def _user_bucket(self, user_id):
+        bucket = self._users.pop(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate)
+        self._users[user_id] = bucket
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return bucket
+
+    def _buckets(self, user_id):
+        if user_id is None:
+            return [self.app]
+        return [self.app, self._user_bucket(str(user_id))]
+
+    def _shared_blocks(self, user_id):
+        """
+        Return until when the app, and the user if given, are blocked
+        according to the store, in the order of ``_buckets``.
+        """
+        names = self._names(user_id)
+        blocked = store.get_many([RATE_LIMIT_BLOCK_CACHE_KEY % name
+                                  for name in names])
+        return [blocked.get(RATE_LIMIT_BLOCK_CACHE_KEY % name, 0)
+                for name in names]
+
+    def _share_block(self, name, until):
+        store.set(RATE_LIMIT_BLOCK_CACHE_KEY % name, until,
+                  int(until - time.time()) + 1)
+
+    def _names(self, user_id):
+        return ['app'] if user_id is None else ['app', str(user_id)]
+
+    def wait_time(self, user_id=None):
+        """
+        Return the seconds to wait before the app, and the user if given, can
+        make a call. Doesn't take a token or create a bucket for the user.
+        """
+        blocked = self._shared_blocks(user_id)
+        now = time.time()
+        with self._lock:
+            buckets = [self._apps.get(get_current_app().app_id)]
+            if user_id is not None:
+                buckets.append(self._users.get(str(user_id)))
+            waits = [b.wait_time(now) for b in buckets if b is not None]
+        return max([0] + waits + [until - now for until in blocked])
+
+    def acquire(self, user_id=None, max_wait=None):
+        """
+        Take a token for a call of the app, and the user if given, and return
+        the seconds to wait before making it. Raises ``RateLimited`` without
+        taking a token when that is more than ``max_wait`` seconds.
+        """
+        blocked = self._shared_blocks(user_id)
+        now = time.time()
+        with self._lock:
+            buckets = self._buckets(user_id)
+            for bucket, until in zip(buckets, blocked):
+                bucket.blocked_until = max(bucket.blocked_until, until)
+            wait = max(b.wait_time(now) for b in buckets)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimited(wait)
+            return max(b.take(now) for b in buckets)
+
+    def pace(self, user_id=None):
+        """
+        Wait until a call can be made, and take a token for it. Raises
+        ``RateLimited`` when that takes longer than ``max_wait`` seconds.
+        """
+        try:
+            wait = self.acquire(user_id, self.max_wait)
+        except RateLimited:
+            stats.incr('ratelimit.deferred')
+            raise
+        if wait:
+            stats.timing('ratelimit.paced', wait * 1000)
+            time.sleep(wait)
+
+    def update(self, headers, user_id=None):
+        """Adjust the app bucket to the usage headers of a Graph response."""
+        usage, regain = [], 0
+        value = headers.get('x-app-usage')
+        if value:
+            usage.append(_parse_usage(value))
+        value = headers.get('x-business-use-case-usage')
+        if value:
+            try:
+                cases = sum(json.loads(value).values(), [])
+            except (AttributeError, TypeError, ValueError):
+                cases = []
+            for case in cases:
+                usage.append(_parse_usage(case))
+                regain = max(regain,
+                             case.get('estimated_time_to_regain_access', 0))
+        if not usage:
+            return
+
+        usage = max(usage)
+        stats.histogram('ratelimit.app_usage', usage)
+        until = None
+        with self._lock:
+            app = self.app
+            app.usage = usage
+            if usage >= 100:
+                until = self._block(app, regain * 60 or self.block_time)
+            elif app.base_rate and usage > self.threshold:
+                factor = (100. - usage) / (100 - self.threshold)
+                app.rate = max(app.base_rate * factor, 0.01)
+            else:
+                app.rate = app.base_rate
+        if until:
+            self._share_block('app', until)
+
+    def record_error(self, error, user_id=None):
+        """Block the app or the user when ``error`` says a limit is reached."""
+        result = getattr(error, 'result', None)
+        try:
+            code = result['error']['code']
+        except (KeyError, TypeError):
+            return
+        if code in APP_LIMIT_ERRORS:
+            name = 'app'
+        elif code in USER_LIMIT_ERRORS and user_id is not None:
+            name = str(user_id)
+        else:
+            return
+        with self._lock:
+            bucket = self.app if name == 'app' else self._user_bucket(name)
+            until = self._block(bucket, self.block_time)
+        if until:
+            self._share_block(name, until)
+
+    def _block(self, bucket, seconds):
+        """
+        Block the bucket for ``seconds``, and return until when, or None when
+        it already was blocked for longer.
+        """
+        until = time.time() + seconds
+        if until > bucket.blocked_until:
+            log.warning('Facebook rate limit reached, pausing for %ss'
+                        % seconds)
+            stats.incr('ratelimit.blocked')
+            bucket.blocked_until = until
+            return until
+
+    def state(self):
+        """Return the state of the buckets, for monitoring."""
+        now = time.time()
+        with self._lock:
+            blocked = dict((user_id, round(b.blocked_until - now, 1))
+                           for user_id, b in self._users.items()
+                           if b.blocked_until > now)
+            apps = dict((app_id, dict(b.state(now), usage=b.usage))
+                        for app_id, b in self._apps.items())
+            return {'apps': apps,
+                    'users': len(self._users),
+                    'blocked_users': blocked}
+
+
+def _parse_usage(value):
+    """
+    Return the highest percentage in a usage header value, or dict of one.
+    """
+    if not isinstance(value, dict):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return 0
+    return max([value.get(key) or 0
+                for key in ('call_count', 'total_time', 'total_cputime')])
+
+
+limiter = RateLimiter(conf.RATE_LIMIT_APP_RATE, conf.RATE_LIMIT_USER_RATE,
+                      conf.RATE_LIMIT_THRESHOLD, conf.RATE_LIMIT_BLOCK_TIME,
+                      conf.RATE_LIMIT_MAX_WAIT)
@@ -0,0 +1,208 @@
+"""
+Serving several facebook apps from one deployment.
+
+The app configured with FACEBOOK_APP_ID, FACEBOOK_APP_SECRET and
+FACEBOOK_REDIRECT_URI is the default app. More apps are configured with
+FACEBOOK_APPS::
+
+    FACEBOOK_APPS = {
+        'games': {
+            'APP_ID': '...',
+            'APP_SECRET': '...',
+            'REDIRECT_URI': 'https://games.example.com/',
+            'HOSTS': ['games.example.com'],
+        },
+        'shop': {
+            ...
+            'PATH_PREFIX': '/shop/',
+        },
+    }
+
+The facebook middlewares pick the app for every request by its host, or else
+by the prefix of its path, and activate it for the rest of the request.
+Everything in django_facebook then works with the active app, see
+``get_current_app``. Cache keys are prefixed with the app id of apps other
+than the default app, so one process can serve all of them.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+from contextlib import contextmanager
+
+import facebook
+from django.core.exceptions import DisallowedHost, ImproperlyConfigured
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+
+import conf
+
+_local = threading.local()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class FacebookApp(object):
+    """
+    The settings of a facebook app, and everything that can be worked out
+    from them up front: the name of its ``fbsr_`` cookie, the key to verify
+    signed_requests with, a ``facebook.Auth`` and the prefix of its cache
+    keys.
+    """
+
+    def __init__(self, name, app_id, app_secret, redirect_uri, canvas_page='',
+                 hosts=(), path_prefix=None, key_prefix=None, auth=None):
+        self.name = name
+        self.app_id = str(app_id)
+        self.app_secret = app_secret
+        self.redirect_uri = redirect_uri
+        self.canvas_page = canvas_page
+        self.hosts = [host.lower() for host in hosts]
+        self.path_prefix = path_prefix
+        self.cookie_name = 'fbsr_%s' % self.app_id
+        self.key_prefix = '%s:' % self.app_id if key_prefix is None \
+            else key_prefix
+        self.hmac_key = force_bytes(app_secret)
+        self.auth = auth or facebook.Auth(self.app_id, app_secret,
+                                          redirect_uri, conf.VERSION)
+
+    def __repr__(self):
+        return '<FacebookApp %s (%s)>' % (self.name, self.app_id)
+
+    def parse_signed_request(self, signed_request):
+        """
+        Return the data in a signed_request of this app, like
+        ``facebook.Auth.parse_signed_request``. Raises ValueError if it is
+        malformed or not signed by facebook for this app.
+        """
+        try:
+            encoded_sig, payload = force_bytes(signed_request).split(b'.', 1)
+            sig = _b64decode(encoded_sig)
+            data = json.loads(_b64decode(payload).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise ValueError('signed_request malformed')
+        if not isinstance(data, dict) or \
+                data.get('algorithm', '').upper() != 'HMAC-SHA256':
+            raise ValueError('signed_request used unknown algorithm')
+        expected_sig = hmac.new(self.hmac_key, payload,
+                                hashlib.sha256).digest()
+        if not hmac.compare_digest(sig, expected_sig):
+            raise ValueError('signed_request had signature mismatch')
+        return data
+
+
+class AppRegistry(object):
+    """
+    The configured facebook apps, by name, host and path prefix.
+    """
+
+    def __init__(self, default, apps=()):
+        self.default = default
+        self.apps = {default.name: default}
+        self.by_host = {}
+        self.by_path = []
+        for app in apps:
+            self.apps[app.name] = app
+            for host in app.hosts:
+                self.by_host[host] = app
+            if app.path_prefix:
+                self.by_path.append((app.path_prefix, app))
+        # Longest prefixes first, so the most specific one wins
+        self.by_path.sort(key=lambda item: -len(item[0]))
+
+    def get(self, name=None):
+        """Return the app with the name, or the default app for None."""
+        if name is None:
+            return self.default
+        try:
+            return self.apps[name]
+        except KeyError:
+            raise ImproperlyConfigured('Unknown facebook app %r' % name)
+
+    def for_request(self, request):
+        """Return the app to use for the request."""
+        if self.by_host:
+            try:
+                host = request.get_host().rsplit(':', 1)[0].lower()
+            except DisallowedHost:
+                host = None
+            app = self.by_host.get(host)
+            if app is not None:
+                return app
+        for prefix, app in self.by_path:
+            if request.path.startswith(prefix):
+                return app
+        return self.default
+
+
+def _build_registry():
+    default = FacebookApp('default', conf.APP_ID, conf.APP_SECRET,
+                          conf.REDIRECT_URI, canvas_page=conf.CANVAS_PAGE,
+                          key_prefix='', auth=conf.auth)
+    apps = []
+    for name, options in conf.APPS.items():
+        try:
+            apps.append(FacebookApp(
+                name, options['APP_ID'], options['APP_SECRET'],
+                options['REDIRECT_URI'],
+                canvas_page=options.get('CANVAS_PAGE', ''),
+                hosts=options.get('HOSTS', ()),
+                path_prefix=options.get('PATH_PREFIX')))
+        except KeyError as e:
+            raise ImproperlyConfigured('FACEBOOK_APPS[%r] needs a %s'
+                                       % (name, e))
+    return AppRegistry(default, apps)
+
+
+registry = _build_registry()
+
+
+def get_current_app():
+    """Return the app that is active in this thread, or the default app."""
+    return getattr(_local, 'app', None) or registry.default
+
+
+def activate(app):
+    """
+    Activate the app, or the app with that name, in this thread. ``None``
+    activates the default app.
+    """
+    if not isinstance(app, FacebookApp):
+        app = registry.get(app)
+    _local.app = app
+    return app
+
+
+def deactivate():
+    _local.app = None
+
+
+@contextmanager
+def override(app):
+    """Activate the app, or app with that name, for a block of code."""
+    previous = getattr(_local, 'app', None)
+    try:
+        yield activate(app)
+    finally:
+        _local.app = previous
+
+
+def activate_for_request(request):
+    """
+    Activate the app of the request, and set it as ``request.facebook_app``.
+    Only picks the app the first time it's called for a request.
+    """
+    app = getattr(request, 'facebook_app', None)
+    if app is None:
+        app = request.facebook_app = registry.for_request(request)
+    _local.app = app
+    return app
+
+
+@receiver(request_finished)
+def _deactivate_on_request_finished(**kwargs):
+    deactivate()
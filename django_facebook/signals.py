@@ -1,3 +1,4 @@
 from django.dispatch import Signal
 
-facebook_user_created = Signal(providing_args=["user", "access_token"])
\ No newline at end of file
+facebook_user_created = Signal(providing_args=["user", "access_token"])
+facebook_users_created = Signal(providing_args=["users"])
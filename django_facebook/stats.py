@@ -0,0 +1,128 @@
+"""
+Instrumentation of the facebook hot paths: counters, timers and histograms.
+
+The metrics are sent to the backend configured with FACEBOOK_STATS_BACKEND,
+which by default throws them away. A backend is any object with ``incr``,
+``timing`` and ``histogram`` methods, so it is easy to write one for e.g.
+prometheus_client. With the ``middleware.FacebookStatsMiddleware``
+installed, a summary of the metrics of every request is logged to the
+``django_facebook.stats`` logger as well.
+"""
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+
+from django.utils.module_loading import import_string
+
+import conf
+
+log = logging.getLogger('django_facebook.stats')
+
+_local = threading.local()
+
+
+class NullBackend(object):
+    """
+    Backend that does nothing.
+    """
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, ms):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+
+class StatsdBackend(NullBackend):
+    """
+    Backend that sends the metrics to a StatsD server over UDP, prefixed by
+    FACEBOOK_STATS_PREFIX.
+    """
+
+    def __init__(self, address=None, prefix=None):
+        self.address = address or conf.STATSD_ADDRESS
+        self.prefix = conf.STATS_PREFIX if prefix is None else prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        data = '%s.%s:%s|%s' % (self.prefix, name, value, kind)
+        try:
+            self.socket.sendto(data.encode('ascii'), self.address)
+        except socket.error:
+            # Never let metrics break a request
+            pass
+
+    def incr(self, name, value=1):
+        self.send(name, value, 'c')
+
+    def timing(self, name, ms):
+        self.send(name, '%.3f' % ms, 'ms')
+
+    def histogram(self, name, value):
+        self.send(name, value, 'h')
+
+
+backend = import_string(conf.STATS_BACKEND)()
+
+
+def _record(name, value):
+    summary = getattr(_local, 'summary', None)
+    if summary is not None:
+        summary[name] = summary.get(name, 0) + value
+
+
+def incr(name, value=1):
+    backend.incr(name, value)
+    _record(name, value)
+
+
+def timing(name, ms):
+    backend.timing(name, ms)
+    _record(name + '_ms', ms)
+
+
+def histogram(name, value):
+    backend.histogram(name, value)
+
+
+class timer(object):
+    """
+    Time a block of code, or a function when used as a decorator, and send
+    the duration in milliseconds as a timing metric.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timing(self.name, (time.time() - self.start) * 1000)
+
+    def __call__(self, func):
+        @wraps(func)
+        def _timed(*args, **kwargs):
+            with timer(self.name):
+                return func(*args, **kwargs)
+        return _timed
+
+
+def start_request():
+    """Start collecting the metrics of the current request."""
+    _local.summary = {}
+
+
+def end_request():
+    """
+    Stop collecting the metrics of the current request, and return them.
+    """
+    summary = getattr(_local, 'summary', None)
+    _local.summary = None
+    return summary or {}
@@ -0,0 +1,197 @@
+"""
+Stores for the access_tokens and user data that django_facebook caches.
+
+Which store is used is configured with the ``FACEBOOK_CACHE_STORE`` setting.
+Keys are prefixed with the ``key_prefix`` of the active facebook app (see
+``registry``), so the data of different apps doesn't mix.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+
+import conf
+from .registry import get_current_app
+
+# Marks keys that are known to be missing in the local cache
+MISSING = object()
+
+
+class CacheStore(object):
+    """
+    Store that keeps everything in the django cache.
+    """
+
+    def __init__(self, cache=cache):
+        self.cache = cache
+
+    def make_key(self, key):
+        return get_current_app().key_prefix + key
+
+    def make_keys(self, keys):
+        """Return a dict mapping the prefixed keys to the keys."""
+        prefix = get_current_app().key_prefix
+        return dict((prefix + key, key) for key in keys)
+
+    def get(self, key, default=None):
+        return self.cache.get(self.make_key(key), default)
+
+    def get_many(self, keys):
+        keys = self.make_keys(keys)
+        return dict((keys[k], v)
+                    for k, v in self.cache.get_many(list(keys)).items())
+
+    def get_shared(self, key, default=None):
+        """Like ``get``, but never answered from a copy in process memory."""
+        return self.cache.get(self.make_key(key), default)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self.cache.set(self.make_key(key), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        return self.cache.add(self.make_key(key), value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        prefix = get_current_app().key_prefix
+        self.cache.set_many(dict((prefix + k, v) for k, v in data.items()),
+                            timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def delete_many(self, keys):
+        self.cache.delete_many(list(self.make_keys(keys)))
+
+
+class TwoTierStore(CacheStore):
+    """
+    Store that keeps a short lived copy of what it reads from and writes to the
+    django cache in process memory, so most requests don't need a round-trip
+    to the shared cache.
+
+    Writes and deletes through this store update the local copy right away.
+    Changes made by other processes are seen after at most ``local_ttl``
+    seconds. Keys that don't exist are remembered as missing too, except for
+    keys starting with one of ``shared_prefixes``: processes coordinate
+    through those (access_tokens and their locks, canvas nonces, rate limit
+    pauses), so a key set by another process must be seen right away. At most
+    ``max_size`` keys are kept, the least recently used ones are dropped.
+    """
+    shared_prefixes = ('_fb_access_token_', '_fb_canvas_nonce_',
+                       '_fb_ratelimit_blocked_')
+
+    def __init__(self, cache=cache, local_ttl=None, max_size=None):
+        super(TwoTierStore, self).__init__(cache)
+        self.local_ttl = conf.LOCAL_CACHE_TTL if local_ttl is None \
+            else local_ttl
+        self.max_size = conf.LOCAL_CACHE_SIZE if max_size is None \
+            else max_size
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # Keep the least recently used keys at the front, for eviction
+                self._local[key] = entry
+                return entry
+        return None
+
+    def _del_local(self, keys):
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def _set_read(self, key, name, value):
+        # Copy what was read from the cache, name is the key without prefix
+        if value is not MISSING or not name.startswith(self.shared_prefixes):
+            self._set_local(key, value)
+
+    def _set_local(self, key, value, timeout=DEFAULT_TIMEOUT):
+        ttl = self.local_ttl
+        if timeout not in (DEFAULT_TIMEOUT, None):
+            ttl = min(ttl, timeout)
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = (time.time() + ttl, value)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def get(self, key, default=None):
+        name, key = key, self.make_key(key)
+        entry = self._get_local(key)
+        if entry is None:
+            value = self.cache.get(key, MISSING)
+            self._set_read(key, name, value)
+        else:
+            value = entry[1]
+        return default if value is MISSING else value
+
+    def get_many(self, keys):
+        keys = self.make_keys(keys)
+        result = {}
+        missing = []
+        for key in keys:
+            entry = self._get_local(key)
+            if entry is None:
+                missing.append(key)
+            elif entry[1] is not MISSING:
+                result[keys[key]] = entry[1]
+        if missing:
+            found = self.cache.get_many(missing)
+            for key in missing:
+                value = found.get(key, MISSING)
+                self._set_read(key, keys[key], value)
+                if value is not MISSING:
+                    result[keys[key]] = value
+        return result
+
+    def get_shared(self, key, default=None):
+        key = self.make_key(key)
+        value = self.cache.get(key, MISSING)
+        if value is MISSING:
+            self._del_local([key])
+        else:
+            self._set_local(key, value)
+        return default if value is MISSING else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        key = self.make_key(key)
+        self.cache.set(key, value, timeout)
+        self._set_local(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        key = self.make_key(key)
+        # Only the shared cache can tell whether the key exists everywhere
+        added = self.cache.add(key, value, timeout)
+        if added:
+            self._set_local(key, value, timeout)
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        prefix = get_current_app().key_prefix
+        data = dict((prefix + k, v) for k, v in data.items())
+        self.cache.set_many(data, timeout)
+        for key, value in data.items():
+            self._set_local(key, value, timeout)
+
+    def delete(self, key):
+        key = self.make_key(key)
+        self.cache.delete(key)
+        self._del_local([key])
+
+    def delete_many(self, keys):
+        keys = list(self.make_keys(keys))
+        self.cache.delete_many(keys)
+        self._del_local(keys)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+
+store = import_string(conf.CACHE_STORE)()
@@ -0,0 +1,213 @@
+"""
+Syncing of (paged) facebook connections, like the friends of a user.
+"""
+import hashlib
+import logging
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import facebook
+import requests
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+import conf
+from .graph import get_graph_api
+from .ratelimit import RateLimited
+from .registry import get_current_app, override
+from .store import store
+from .utils import get_cached_access_tokens
+
+FB_FRIENDS_CURSOR_CACHE_KEY = '_fb_friends_cursor_%s_%s'
+
+log = logging.getLogger('django_facebook.sync')
+
+
+class _PageFetch(threading.Thread):
+    """
+    Fetches a page of a connection in the background, with the app of the
+    thread that started it active.
+    """
+
+    def __init__(self, graph, uri):
+        super(_PageFetch, self).__init__()
+        self.daemon = True
+        self.graph = graph
+        self.uri = uri
+        self.app = get_current_app()
+        self.result = None
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            with override(self.app):
+                self.result = self.graph.bare_request(self.uri)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+        return self.result
+
+
+def iter_connection_pages(graph, id, connection_name, next_uri=None,
+                          prefetch=False, **args):
+    """
+    Generator that yields the pages of a connection as ``(items, next_uri)``
+    tuples, where ``next_uri`` is the uri of the page after it, or ``None``
+    for the last page.
+
+    Pass ``next_uri`` to start at that page instead of the first one. With
+    ``prefetch`` the next page is fetched in a background thread while the
+    caller works on the current one, so at most two pages are held at a time.
+    """
+    if next_uri:
+        data = graph.bare_request(next_uri)
+    else:
+        data = graph.get_connections(id, connection_name, **args)
+    while True:
+        next_uri = data.get('paging', {}).get('next')
+        fetch = _PageFetch(graph, next_uri) if prefetch and next_uri else None
+        yield data['data'], next_uri
+        if not next_uri:
+            return
+        data = fetch.get() if fetch else graph.bare_request(next_uri)
+
+
+def connection_args(page_size=None, fields=None):
+    """
+    Return the arguments to request pages of ``page_size`` items, with only
+    the ``fields`` (a list, or a comma separated string) if given.
+    """
+    args = {}
+    if page_size:
+        args['limit'] = page_size
+    if fields:
+        args['fields'] = fields if isinstance(fields, six.string_types) \
+            else ','.join(fields)
+    return args
+
+
+def iter_connection(graph, id, connection_name, page_size=None, fields=None,
+                    prefetch=True):
+    """
+    Generator that yields the items of a connection one by one, across all of
+    its pages, fetching ``page_size`` items per call. Only the ``fields``
+    (a list, or a comma separated string) are requested when given. See
+    ``iter_connection_pages``, the next page is prefetched by default.
+    """
+    pages = iter_connection_pages(graph, id, connection_name,
+                                  prefetch=prefetch,
+                                  **connection_args(page_size, fields))
+    for items, _ in pages:
+        for item in items:
+            yield item
+
+
+class FriendsSync(object):
+    """
+    Passes the friends of a facebook user to ``callback``, in lists of at most
+    about ``batch_size`` friends.
+
+    After every call to ``callback`` a cursor is saved in the cache, so when
+    fetching a page fails, calling ``run`` with ``resume=True`` continues after
+    the friends that were already handled. The cursor is kept per user and
+    ``cursor_name``, which identifies the callback and defaults to its module
+    and name.
+
+    Pass ``graph`` to use that instead of a ``PooledGraphAPI`` for the
+    access_token, which is paced by ``ratelimit.limiter``. ``fields`` limits
+    the fields fetched of every friend. The next page is fetched while the
+    callback handles the current batch.
+    """
+    cursor_timeout = 24 * 3600
+
+    def __init__(self, fb_id, access_token, callback, batch_size=None,
+                 page_size=500, graph=None, fields=None, cursor_name=None):
+        self.fb_id = fb_id
+        self.graph = graph or get_graph_api(access_token, user_id=fb_id,
+                                            paced=True)
+        self.callback = callback
+        self.batch_size = batch_size or conf.SYNC_BATCH_SIZE
+        self.page_size = page_size
+        self.fields = fields
+        if cursor_name is None:
+            cursor_name = '%s.%s' % (getattr(callback, '__module__', ''),
+                                     getattr(callback, '__name__', ''))
+        self.cursor_key = FB_FRIENDS_CURSOR_CACHE_KEY % (
+            fb_id, hashlib.sha1(force_bytes(cursor_name)).hexdigest())
+
+    def run(self, next_uri=None, resume=False):
+        """
+        Sync the friends, starting at ``next_uri`` if given, or with
+        ``resume`` at the cursor saved by a failed run. Returns the number of
+        friends passed to the callback.
+        """
+        if resume and not next_uri:
+            next_uri = store.get(self.cursor_key)
+            if next_uri:
+                log.debug('Resuming friends sync for %s' % self.fb_id)
+
+        count = 0
+        batch = []
+        pages = iter_connection_pages(
+            self.graph, 'me', 'friends', next_uri=next_uri, prefetch=True,
+            **connection_args(self.page_size, self.fields))
+        for items, next_uri in pages:
+            batch.extend(items)
+            if len(batch) >= self.batch_size and next_uri:
+                self.callback(batch)
+                count += len(batch)
+                batch = []
+                store.set(self.cursor_key, next_uri, self.cursor_timeout)
+
+        if batch:
+            self.callback(batch)
+            count += len(batch)
+        store.delete(self.cursor_key)
+        return count
+
+
+def sync_friends_for_users(fb_ids, callback, concurrency=None, session=None,
+                           fields=None, cursor_name=None):
+    """
+    Sync the friends of many users, ``concurrency`` users at a time. See
+    ``FriendsSync``, which is passed ``fields`` and ``cursor_name``. All calls
+    go over ``session``, or the shared session.
+
+    Users without an access_token in the cache are skipped. Returns a dict
+    mapping the facebook ids of the users that couldn't be synced to the
+    exception that occurred.
+    """
+    access_tokens = get_cached_access_tokens(fb_ids)
+    for fb_id in fb_ids:
+        if fb_id not in access_tokens:
+            log.info('Skipping friends of %s, no access_token in cache' % fb_id)
+
+    app = get_current_app()
+
+    def sync(fb_id):
+        # The pool's threads don't have the app activated
+        try:
+            with override(app):
+                graph = get_graph_api(access_tokens[fb_id], session=session,
+                                      user_id=fb_id, paced=True)
+                FriendsSync(fb_id, None, callback, graph=graph,
+                            fields=fields, cursor_name=cursor_name).run()
+        except (facebook.GraphAPIError, requests.RequestException,
+                RateLimited) as e:
+            log.warning('Syncing friends of %s failed: %s' % (fb_id, e))
+            return fb_id, e
+        return fb_id, None
+
+    pool = ThreadPool(concurrency or conf.SYNC_CONCURRENCY)
+    try:
+        results = pool.map(sync, list(access_tokens))
+    finally:
+        pool.close()
+        pool.join()
+    return dict((fb_id, e) for fb_id, e in results if e is not None)
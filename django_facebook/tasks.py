@@ -1,8 +1,22 @@
+import json
+
 import facebook
+import requests
 from celery.utils.log import get_task_logger
 from django.core.exceptions import ImproperlyConfigured
 
-from .utils import get_cached_access_token
+import conf
+from .utils import (FB_ACCESS_TOKEN_REFRESH_CACHE_KEY, cache_access_token,
+                    exchange_access_token, get_cached_access_token,
+                    get_cached_access_token_expiries,
+                    refresh_access_token_if_needed)
+from .dispatch import send_users_created as _send_users_created
+from .friends import store_friends
+from .ratelimit import RateLimited, limiter
+from .registry import override
+from .store import store
+from .sync import FriendsSync, sync_friends_for_users
+from .webhooks import handle_updates
 
 try:
     from celery import shared_task, subtask
@@ -12,9 +26,18 @@ except ImportError:
 
 log = get_task_logger(__name__)
 
+# All tasks take the name of the facebook app to work for as the ``app``
+# kwarg (see ``registry``), which defaults to the default app.
+
+
+def _cursor_name(callback):
+    # Friends syncs for different callbacks keep their own cursor
+    return json.dumps(callback, sort_keys=True, default=str)
+
 
 @shared_task(bind=True, default_retry_delay=60)
-def get_friends_for_user(self, fb_id, callback, next_uri=None):
+def get_friends_for_user(self, fb_id, callback, next_uri=None, fields=None,
+                         resume=False, app=None):
     """
     Get the facebook friends for the user with fb_id.
 
@@ -24,22 +47,165 @@ def get_friends_for_user(self, fb_id, callback, next_uri=None):
 
     If 1. is not present, the task is delayed
     If 2. is not the case, you're out of luck
+
+    The callback is called with lists of up to about FACEBOOK_SYNC_BATCH_SIZE
+    friends. When fetching a page fails, the retried task resumes after the
+    friends that were already passed to the callback.
+
+    The access_token is always read from the cache, so it doesn't end up in
+    the messages of the broker. Pass ``fields`` to only fetch those fields of
+    the friends.
+
+    While facebook's rate limits for the app or the user are exhausted (see
+    ``ratelimit``), the task is postponed until they are expected to be
+    available again.
+    """
+    with override(app):
+        wait = limiter.wait_time(fb_id)
+        if wait > 1:
+            # Requeue instead of retrying, this is not a failure
+            get_friends_for_user.apply_async(
+                (fb_id, callback, next_uri),
+                {'fields': fields, 'resume': resume, 'app': app},
+                countdown=wait)
+            return
+
+        access_token = get_cached_access_token(fb_id)
+        if access_token is None:
+            raise self.retry(exc=ValueError(
+                "Failed to fetch facebook data for %s. No access_token found "
+                "in cache" % fb_id))
+
+        try:
+            FriendsSync(fb_id, access_token, subtask(callback).delay,
+                        fields=fields, cursor_name=_cursor_name(callback)
+                        ).run(next_uri, resume=resume)
+        except RateLimited as exc:
+            # Continue from the saved cursor once the limits are available
+            get_friends_for_user.apply_async(
+                (fb_id, callback), {'fields': fields, 'resume': True,
+                                    'app': app},
+                countdown=exc.wait)
+        except (facebook.GraphAPIError, requests.RequestException) as exc:
+            # Resume from the saved cursor
+            raise self.retry(exc=exc, args=(fb_id, callback),
+                             kwargs={'fields': fields, 'resume': True,
+                                     'app': app},
+                             countdown=limiter.wait_time(fb_id) or None)
+
+
+@shared_task
+def get_friends_for_users(fb_ids, callback, fields=None, app=None):
+    """
+    Get the facebook friends for many users, see ``get_friends_for_user``.
+
+    The friends of FACEBOOK_SYNC_CONCURRENCY users are fetched at the same
+    time. Users without an access_token in the cache are skipped, users for
+    which it fails are retried in a separate ``get_friends_for_user`` task.
+    """
+    with override(app):
+        failed = sync_friends_for_users(fb_ids, subtask(callback).delay,
+                                        fields=fields,
+                                        cursor_name=_cursor_name(callback))
+        for fb_id in failed:
+            get_friends_for_user.apply_async(
+                (fb_id, callback),
+                {'fields': fields, 'resume': True, 'app': app},
+                countdown=limiter.wait_time(fb_id))
+
+
+@shared_task(bind=True, default_retry_delay=60)
+def store_friends_for_user(self, fb_id, app=None):
+    """
+    Fetch the facebook friends of the user with fb_id and save them as
+    ``Friendship`` rows, see ``friends.store_friends``. Needs a valid
+    access_token in the cache, like ``get_friends_for_user``.
     """
-    access_token = get_cached_access_token(fb_id)
-    if access_token is None:
-        raise self.retry(exc=ValueError("Failed to fetch facebook data for %s. "
-                                        "No access_token found in cache" % fb_id))
+    with override(app):
+        wait = limiter.wait_time(fb_id)
+        if wait > 1:
+            store_friends_for_user.apply_async((fb_id,), {'app': app},
+                                               countdown=wait)
+            return
 
-    graph = facebook.GraphAPI(access_token)
+        access_token = get_cached_access_token(fb_id)
+        if access_token is None:
+            raise self.retry(exc=ValueError(
+                "Failed to fetch facebook data for %s. No access_token found "
+                "in cache" % fb_id))
 
-    try:
-        if next_uri:
-            data = graph.bare_request(next_uri)
-        else:
-            data = graph.get_connections('me', 'friends', limit=500)
-    except facebook.GraphAPIError as exc:
-        raise self.retry(exc=exc)
+        try:
+            store_friends(fb_id, access_token)
+        except RateLimited as exc:
+            store_friends_for_user.apply_async((fb_id,), {'app': app},
+                                               countdown=exc.wait)
+        except (facebook.GraphAPIError, requests.RequestException) as exc:
+            raise self.retry(exc=exc,
+                             countdown=limiter.wait_time(fb_id) or None)
 
-    subtask(callback).delay(data['data'])
-    if 'paging' in data and data['paging'].get('next'):
-        self.delay(fb_id, callback, next_uri=data['paging']['next'])
+
+@shared_task(bind=True, default_retry_delay=60)
+def extend_access_token(self, fb_id, app=None):
+    """
+    Exchange the cached access_token of the user with fb_id for a long lived
+    one, and cache that instead.
+
+    This is queued automatically when FACEBOOK_EXTEND_ACCESS_TOKENS is on.
+    """
+    with override(app):
+        access_token = get_cached_access_token(fb_id)
+        if access_token is None:
+            log.info('Not extending access_token of %s, none found in cache'
+                     % fb_id)
+            return
+
+        try:
+            access_token, expires_in = exchange_access_token(access_token)
+        except (facebook.GraphAPIError, requests.RequestException) as exc:
+            raise self.retry(exc=exc,
+                             countdown=limiter.wait_time(fb_id) or None)
+
+        cache_access_token(fb_id, access_token, expires_in)
+        # Allow a refresh to be queued again for the next access_token, but
+        # not when this one expires within the margin as well (facebook gives
+        # back the same expiry for a long lived access_token), that would
+        # queue this task again right away. The flag expires after the margin
+        if expires_in > conf.ACCESS_TOKEN_REFRESH_MARGIN:
+            store.delete(FB_ACCESS_TOKEN_REFRESH_CACHE_KEY % fb_id)
+    log.debug('Extended access_token of %s, expires in %ss'
+              % (fb_id, expires_in))
+
+
+@shared_task
+def refresh_expiring_access_tokens(fb_ids, app=None):
+    """
+    Queue ``extend_access_token`` for each of the users whose cached
+    access_token expires within FACEBOOK_ACCESS_TOKEN_REFRESH_MARGIN seconds.
+    Meant to be run periodically for your active users.
+    """
+    with override(app):
+        for fb_id, expires in get_cached_access_token_expiries(fb_ids).items():
+            refresh_access_token_if_needed(fb_id, expires)
+
+
+@shared_task
+def handle_webhook_updates(changes, deauthorized, app=None):
+    """
+    Drop the cached data of users that changed or deauthorized the app, as
+    reported by a webhook. See ``webhooks.handle_updates``.
+    """
+    with override(app):
+        handle_updates(changes, deauthorized)
+
+
+@shared_task
+def send_users_created(users):
+    """
+    Send ``facebook_user_created`` for a batch of new users, queued by
+    ``dispatch`` with FACEBOOK_USER_CREATED_DISPATCH set to 'celery'. Every
+    user carries the name of its app, so there is no ``app`` kwarg.
+    """
+    retry = _send_users_created(users)
+    if retry:
+        send_users_created.apply_async(
+            (retry,), countdown=conf.USER_CREATED_BATCH_INTERVAL)
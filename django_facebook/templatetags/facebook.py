@@ -2,19 +2,47 @@ from urllib import quote
 
 from django import template
 from django.conf import settings
-from django.core.urlresolvers import reverse, NoReverseMatch
+from django.core.signals import setting_changed
+from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
 from django_facebook import conf
+from django_facebook.registry import get_current_app
 
 register = template.Library()
 
 
-@register.inclusion_tag('tags/facebook_load.html')
-def facebook_load():
+# Tags in base templates render on every page, so everything that doesn't
+# change between requests is rendered once and kept here.
+_fragments = {}
+
+
+@receiver(setting_changed)
+def clear_fragments(**kwargs):
+    _fragments.clear()
+
+
+def _memoize(key, func):
+    try:
+        return _fragments[key]
+    except KeyError:
+        value = _fragments[key] = func()
+        return value
+
+
+def get_fb_locale(language_code):
     # LANGUAGE_CODE defaults to en-us, which is also the default for FB
-    lang, country = settings.LANGUAGE_CODE.split('-')
-    fb_locale = "%s_%s" % (lang, country.upper())
-    return {'fb_locale': fb_locale}
+    lang, _, country = language_code.partition('-')
+    return "%s_%s" % (lang, (country or lang).upper())
+
+
+@register.simple_tag
+def facebook_load():
+    return _memoize(('load', settings.LANGUAGE_CODE), lambda: mark_safe(
+        render_to_string('tags/facebook_load.html', {
+            'fb_locale': get_fb_locale(settings.LANGUAGE_CODE)})))
 
 
 @register.tag
@@ -26,24 +54,34 @@ def facebook_init(parser, token):
 
 class FacebookNode(template.Node):
     """ Allow code to be added inside the facebook asynchronous closure. """
+    # Stands in for the code when rendering the static parts around it
+    placeholder = '__django_facebook_code__'
+
     def __init__(self, nodelist):
-        try:
-            app_id = conf.APP_ID
-        except AttributeError:
-            raise template.TemplateSyntaxError, "%r tag requires " \
-                "FACEBOOK_APP_ID to be configured." \
-                % token.contents.split()[0]
-        self.app_id = app_id
         self.nodelist = nodelist
 
+    def get_fragments(self):
+        """
+        Return the parts of tags/facebook_init.html before and after the
+        code, or just the html of an overridden template without the code.
+        """
+        html = render_to_string('tags/facebook_init.html', {
+            'code': self.placeholder,
+            'app_id': get_current_app().app_id,
+            'version': conf.VERSION,
+        })
+        return html.split(self.placeholder, 1)
+
     def render(self, context):
-        t = template.loader.get_template('tags/facebook_init.html')
-        code = self.nodelist.render(context)
-        custom_context = context
-        custom_context['code'] = code
-        custom_context['app_id'] = self.app_id
-        custom_context['version'] = getattr(settings, 'FACEBOOK_VERSION', '2.2')
-        return t.render(custom_context)
+        # The code is rendered in the caller's context, but nothing is added
+        # to it
+        fragments = _memoize(('init', get_current_app().app_id,
+                              get_urlconf(), get_script_prefix()),
+                             self.get_fragments)
+        if len(fragments) == 1:
+            return mark_safe(fragments[0])
+        before, after = fragments
+        return mark_safe(before + self.nodelist.render(context) + after)
 
 
 @register.simple_tag
@@ -61,12 +99,18 @@ def facebook_login_url(request, redirect_after=None):
     """
     login_url = 'https://www.facebook.com/dialog/oauth?' + \
         'client_id=%s&scope=%s&redirect_uri=%s'
-    redirect_to = reverse('djfb_login')
+    redirect_to = _reverse('djfb_login')
     if redirect_after:
         if redirect_after.startswith('/'):
             redirect_to += '?next=%s' % quote(redirect_after)
         else:
-            redirect_to += '?next=%s' % quote(reverse(redirect_after))
-    return login_url % (conf.APP_ID,
+            redirect_to += '?next=%s' % quote(_reverse(redirect_after))
+    return login_url % (get_current_app().app_id,
                         facebook_perms(),
                         request.build_absolute_uri(redirect_to))
+
+
+def _reverse(name):
+    # Only url names are memoized, paths can differ for every request
+    return _memoize(('reverse', name, get_urlconf(), get_script_prefix()),
+                    lambda: reverse(name))
@@ -0,0 +1,34 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_facebook.auth import FacebookModelBackend
+
+User = get_user_model()
+
+
+class GetUserTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.backend = FacebookModelBackend()
+
+    def test_known_user(self):
+        user = User.objects.create(username='1331235', password='!')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user('1331235'), user)
+
+    def test_new_user(self):
+        user = self.backend.get_user('1331235')
+        self.assertEqual(user.username, '1331235')
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(self.backend.get_user('1331235'), user)
+
+    def test_created_concurrently(self):
+        user = User.objects.create(username='1331235', password='!')
+        self.assertEqual(self.backend.create_user('1331235'), (user, False))
+
+    def test_not_created(self):
+        self.backend.create_on_not_found = False
+        self.assertIsNone(self.backend.get_user('1331235'))
+        self.assertFalse(User.objects.exists())
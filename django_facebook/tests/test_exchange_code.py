@@ -0,0 +1,103 @@
+import hashlib
+
+import facebook
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_facebook import conf, utils
+from django_facebook.store import store
+from django_facebook.utils import (EXCHANGE_FAILED,
+                                   FB_ACCESS_TOKEN_CACHE_KEY,
+                                   FB_ACCESS_TOKEN_LOCK_CACHE_KEY,
+                                   exchange_code)
+
+LOCK_KEY = FB_ACCESS_TOKEN_LOCK_CACHE_KEY % (
+    '1331235', hashlib.sha1(b'code').hexdigest())
+TOKEN_KEY = FB_ACCESS_TOKEN_CACHE_KEY % '1331235'
+
+
+class ExchangeCodeTest(TestCase):
+    """
+    Concurrent requests are played by holding the lock and by changing the
+    cache while the loser sleeps between polls.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.exchanged = []
+        self.sleeps = []
+        self.on_sleep = None
+        self.saved = (utils.get_access_token_from_code, utils.time.sleep,
+                      conf.ACCESS_TOKEN_LOCK_TIMEOUT)
+        utils.get_access_token_from_code = self.exchange
+        utils.time.sleep = self.sleep
+
+    def tearDown(self):
+        (utils.get_access_token_from_code, utils.time.sleep,
+         conf.ACCESS_TOKEN_LOCK_TIMEOUT) = self.saved
+
+    def exchange(self, code, redirect_uri=None):
+        self.exchanged.append(code)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+    def test_winner(self):
+        self.result = {'access_token': 'token', 'expires': 3600}
+        self.assertEqual(exchange_code('1331235', 'code'), 'token')
+        self.assertEqual(self.exchanged, ['code'])
+        self.assertEqual(store.get_shared(TOKEN_KEY), 'token')
+        self.assertIsNone(store.get_shared(LOCK_KEY))
+
+    def test_winner_after_exchange_by_other(self):
+        # The other request released the lock right before we took it
+        store.set(TOKEN_KEY, 'token')
+        self.result = AssertionError('exchanged twice')
+        self.assertEqual(exchange_code('1331235', 'code'), 'token')
+        self.assertEqual(self.exchanged, [])
+        self.assertIsNone(store.get_shared(LOCK_KEY))
+
+    def test_loser(self):
+        store.add(LOCK_KEY, True)
+        self.result = AssertionError('exchanged twice')
+        self.on_sleep = lambda: store.set(TOKEN_KEY, 'token')
+        self.assertEqual(exchange_code('1331235', 'code'), 'token')
+        self.assertEqual(self.exchanged, [])
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_loser_retries_after_release(self):
+        # The winner failed without using up the code
+        store.add(LOCK_KEY, True)
+        self.result = {'access_token': 'token', 'expires': 3600}
+        self.on_sleep = lambda: store.delete(LOCK_KEY)
+        self.assertEqual(exchange_code('1331235', 'code'), 'token')
+        self.assertEqual(self.exchanged, ['code'])
+
+    def test_failed_exchange(self):
+        self.result = facebook.GraphAPIError({'error': {
+            'type': 'OAuthException', 'message': 'Code was used'}})
+        with self.assertRaises(facebook.GraphAPIError):
+            exchange_code('1331235', 'code')
+        self.assertEqual(store.get_shared(LOCK_KEY), EXCHANGE_FAILED)
+
+        # Requests with the same code don't try it again
+        with self.assertRaises(facebook.AuthError):
+            exchange_code('1331235', 'code')
+        self.assertEqual(self.exchanged, ['code'])
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_poll_timeout(self):
+        conf.ACCESS_TOKEN_LOCK_TIMEOUT = 0.2
+        store.add(LOCK_KEY, True)
+        self.result = AssertionError('exchanged twice')
+        real_sleep = self.saved[1]
+        self.on_sleep = lambda: real_sleep(utils.ACCESS_TOKEN_POLL_INTERVAL)
+        with self.assertRaises(facebook.AuthError):
+            exchange_code('1331235', 'code')
+        self.assertEqual(self.exchanged, [])
+        self.assertTrue(self.sleeps)
@@ -0,0 +1,91 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_facebook import store as store_module
+from django_facebook.store import MISSING, TwoTierStore
+
+
+class TwoTierStoreTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        self.time = store_module.time.time
+        store_module.time.time = lambda: self.now
+        self.store = TwoTierStore(local_ttl=5, max_size=3)
+
+    def tearDown(self):
+        store_module.time.time = self.time
+
+    def test_reads_are_kept_locally(self):
+        cache.set('_fb_data_1', 'a')
+        self.assertEqual(self.store.get('_fb_data_1'), 'a')
+        cache.set('_fb_data_1', 'b')
+        self.assertEqual(self.store.get('_fb_data_1'), 'a')
+        self.assertEqual(self.store.get_many(['_fb_data_1']),
+                         {'_fb_data_1': 'a'})
+
+    def test_ttl_expiry(self):
+        self.store.set('_fb_data_1', 'a')
+        cache.set('_fb_data_1', 'b')
+        self.now += 4.9
+        self.assertEqual(self.store.get('_fb_data_1'), 'a')
+        self.now += 0.2
+        self.assertEqual(self.store.get('_fb_data_1'), 'b')
+
+    def test_shorter_timeout(self):
+        self.store.set('_fb_data_1', 'a', timeout=1)
+        cache.delete('_fb_data_1')
+        self.now += 1.1
+        self.assertIsNone(self.store.get('_fb_data_1'))
+
+    def test_lru_eviction(self):
+        self.store.set_many({'_fb_data_1': 1, '_fb_data_2': 2})
+        self.store.set('_fb_data_3', 3)
+        # Reading a key makes it the most recently used one
+        self.store.get('_fb_data_1')
+        self.store.set('_fb_data_4', 4)
+        self.assertEqual(list(self.store._local),
+                         ['_fb_data_3', '_fb_data_1', '_fb_data_4'])
+        cache.set('_fb_data_2', 'shared')
+        self.assertEqual(self.store.get('_fb_data_2'), 'shared')
+
+    def test_misses_are_kept_locally(self):
+        self.assertIsNone(self.store.get('_fb_data_1'))
+        self.assertIs(self.store._local['_fb_data_1'][1], MISSING)
+        cache.set('_fb_data_1', 'a')
+        self.assertIsNone(self.store.get('_fb_data_1'))
+        self.assertEqual(self.store.get_many(['_fb_data_1']), {})
+
+    def test_coordination_misses_are_not_kept(self):
+        self.assertIsNone(self.store.get('_fb_access_token_1'))
+        self.assertEqual(self.store.get_many(['_fb_canvas_nonce_x']), {})
+        cache.set('_fb_access_token_1', 'token')
+        cache.set('_fb_canvas_nonce_x', True)
+        self.assertEqual(self.store.get('_fb_access_token_1'), 'token')
+        self.assertEqual(self.store.get_many(['_fb_canvas_nonce_x']),
+                         {'_fb_canvas_nonce_x': True})
+
+    def test_delete(self):
+        self.store.set_many({'_fb_data_1': 1, '_fb_data_2': 2,
+                             '_fb_data_3': 3})
+        self.store.delete('_fb_data_1')
+        self.store.delete_many(['_fb_data_2', '_fb_data_3'])
+        self.assertEqual(self.store._local, {})
+        self.assertEqual(cache.get_many(['_fb_data_1', '_fb_data_2',
+                                         '_fb_data_3']), {})
+        self.assertIsNone(self.store.get('_fb_data_1'))
+
+    def test_get_shared(self):
+        self.store.set('_fb_data_1', 'a')
+        cache.set('_fb_data_1', 'b')
+        self.assertEqual(self.store.get_shared('_fb_data_1'), 'b')
+        self.assertEqual(self.store.get('_fb_data_1'), 'b')
+        cache.delete('_fb_data_1')
+        self.assertIsNone(self.store.get_shared('_fb_data_1'))
+        self.assertNotIn('_fb_data_1', self.store._local)
+
+    def test_add(self):
+        self.assertTrue(self.store.add('_fb_data_1', 'a'))
+        self.assertFalse(self.store.add('_fb_data_1', 'b'))
+        self.assertEqual(self.store.get('_fb_data_1'), 'a')
@@ -0,0 +1,38 @@
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+
+INIT = '{% load facebook %}{% facebook_init %}{{ js }}{% endfacebook_init %}'
+
+
+def templates(**overrides):
+    """TEMPLATES with the given templates in front of the app's."""
+    return [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [
+            ('django.template.loaders.locmem.Loader', overrides),
+            'django.template.loaders.app_directories.Loader',
+        ]},
+    }]
+
+
+class FacebookInitTest(TestCase):
+
+    def render(self, js='FB.api();'):
+        return Template(INIT).render(Context({'js': js}))
+
+    def test_code(self):
+        html = self.render()
+        self.assertIn("appId: '1234'", html)
+        self.assertIn('FB.api();\n}', html)
+        self.assertIn('other();\n}', self.render('other();'))
+
+    @override_settings(TEMPLATES=templates(**{
+        'tags/facebook_init.html': '<i>{{ app_id }}</i>{{ code|safe }}'}))
+    def test_override(self):
+        self.assertEqual(self.render(), '<i>1234</i>FB.api();')
+
+    @override_settings(TEMPLATES=templates(**{
+        'tags/facebook_init.html': '<script>FB.init({{ app_id }})</script>'}))
+    def test_override_without_code(self):
+        self.assertEqual(self.render(), '<script>FB.init(1234)</script>')
+        self.assertEqual(self.render(), '<script>FB.init(1234)</script>')
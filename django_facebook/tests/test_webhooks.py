@@ -0,0 +1,180 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from django_facebook import conf
+from django_facebook.store import store
+from django_facebook.utils import (FB_ACCESS_TOKEN_CACHE_KEY,
+                                   FB_DATA_CACHE_KEY, FB_PROFILE_CACHE_KEY)
+from django_facebook.webhooks import (handle_updates, parse_changes,
+                                      verify_signature)
+
+try:
+    from celery import current_app
+except ImportError:
+    current_app = None
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'webhooks')
+
+
+def load(name):
+    """Return the raw body of a recorded payload."""
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def sign(body, secret=conf.APP_SECRET):
+    return 'sha1=' + hmac.new(secret.encode('utf-8'), body,
+                              hashlib.sha1).hexdigest()
+
+
+def signed_request(data, secret=conf.APP_SECRET):
+    def encode(raw):
+        return base64.urlsafe_b64encode(raw).rstrip(b'=')
+    payload = encode(json.dumps(data).encode('utf-8'))
+    sig = encode(hmac.new(secret.encode('utf-8'), payload,
+                          hashlib.sha256).digest())
+    return (sig + b'.' + payload).decode('ascii')
+
+
+class VerifySignatureTest(TestCase):
+
+    def test_valid(self):
+        body = load('user_changes.json')
+        self.assertTrue(verify_signature(body, sign(body)))
+
+    def test_other_secret(self):
+        body = load('user_changes.json')
+        self.assertFalse(verify_signature(body, sign(body, 'other')))
+
+    def test_changed_body(self):
+        body = load('user_changes.json')
+        self.assertFalse(verify_signature(body + b' ', sign(body)))
+
+    def test_missing_or_malformed(self):
+        body = load('user_changes.json')
+        self.assertFalse(verify_signature(body, None))
+        self.assertFalse(verify_signature(body, ''))
+        self.assertFalse(verify_signature(body, sign(body)[5:]))
+
+
+class ParseChangesTest(TestCase):
+
+    def parse(self, name):
+        return parse_changes(json.loads(load(name).decode('utf-8')))
+
+    def test_changed_fields(self):
+        self.assertEqual(self.parse('user_changes.json'), {
+            '1331235': ['email', 'friends'],
+            '1335845740': ['likes'],
+        })
+
+    def test_changes_are_merged_per_user(self):
+        self.assertEqual(self.parse('user_changes_v2.json'), {
+            '1331235': ['feed', 'name', 'photos'],
+        })
+
+    def test_other_objects_are_ignored(self):
+        self.assertEqual(self.parse('page_changes.json'), {})
+
+
+class WebhookTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('djfb_webhook')
+        if current_app is not None:
+            self.eager = current_app.conf.CELERY_ALWAYS_EAGER
+            current_app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        if current_app is not None:
+            current_app.conf.CELERY_ALWAYS_EAGER = self.eager
+
+    def cache_user(self, user_id):
+        store.set_many({
+            FB_ACCESS_TOKEN_CACHE_KEY % user_id: 'token',
+            FB_DATA_CACHE_KEY % user_id: {'name': 'Jane'},
+            FB_PROFILE_CACHE_KEY % user_id: {'name': 'Jane'},
+        })
+
+    def cached(self, user_id):
+        return sorted(store.get_many([
+            FB_ACCESS_TOKEN_CACHE_KEY % user_id,
+            FB_DATA_CACHE_KEY % user_id,
+            FB_PROFILE_CACHE_KEY % user_id]))
+
+    def test_subscribe(self):
+        response = self.client.get(self.url, {
+            'hub.mode': 'subscribe', 'hub.challenge': '1158201444',
+            'hub.verify_token': conf.WEBHOOK_VERIFY_TOKEN})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'1158201444')
+
+    def test_subscribe_wrong_token(self):
+        response = self.client.get(self.url, {
+            'hub.mode': 'subscribe', 'hub.challenge': '1158201444',
+            'hub.verify_token': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_changes(self):
+        self.cache_user('1331235')
+        self.cache_user('1335845740')
+        body = load('user_changes.json')
+        response = self.client.post(self.url, body,
+                                    content_type='application/json',
+                                    HTTP_X_HUB_SIGNATURE=sign(body))
+        self.assertEqual(response.status_code, 200)
+        # email is a profile field, likes isn't
+        self.assertEqual(self.cached('1331235'),
+                         [FB_ACCESS_TOKEN_CACHE_KEY % '1331235'])
+        self.assertEqual(self.cached('1335845740'), [
+            FB_ACCESS_TOKEN_CACHE_KEY % '1335845740',
+            FB_PROFILE_CACHE_KEY % '1335845740'])
+
+        self.cache_user('1331235')
+        body = load('user_changes_v2.json')
+        self.client.post(self.url, body, content_type='application/json',
+                         HTTP_X_HUB_SIGNATURE=sign(body))
+        self.assertEqual(self.cached('1331235'),
+                         [FB_ACCESS_TOKEN_CACHE_KEY % '1331235'])
+
+    def test_profile_kept_when_no_profile_field_changed(self):
+        self.cache_user('1335845740')
+        handle_updates({'1335845740': ['likes']}, [])
+        self.assertEqual(self.cached('1335845740'), [
+            FB_ACCESS_TOKEN_CACHE_KEY % '1335845740',
+            FB_PROFILE_CACHE_KEY % '1335845740'])
+
+    def test_changes_invalid_signature(self):
+        self.cache_user('1331235')
+        body = load('user_changes.json')
+        response = self.client.post(self.url, body,
+                                    content_type='application/json',
+                                    HTTP_X_HUB_SIGNATURE=sign(body, 'other'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(self.cached('1331235')), 3)
+
+    def test_deauthorize(self):
+        self.cache_user('1331235')
+        self.cache_user('1335845740')
+        data = json.loads(load('deauthorize.json').decode('utf-8'))
+        response = self.client.post(self.url, {
+            'signed_request': signed_request(data)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cached('1331235'), [])
+        self.assertEqual(len(self.cached('1335845740')), 3)
+
+    def test_deauthorize_invalid_signed_request(self):
+        self.cache_user('1331235')
+        data = json.loads(load('deauthorize.json').decode('utf-8'))
+        response = self.client.post(self.url, {
+            'signed_request': signed_request(data, 'other')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.cached('1331235')), 3)
@@ -6,6 +6,7 @@ urlpatterns = patterns('django_facebook.views',
     url(r'^login/$', 'fb_server_login', name='djfb_login'),
     url(r'^login/client/$', 'fb_client_login', name='djfb_clientside_login'),
     url(r'^logout/$', 'fb_logout', name='djfb_logout'),
+    url(r'^webhook/$', 'fb_webhook', name='djfb_webhook'),
 )
 
 if settings.DEBUG:
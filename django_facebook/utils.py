@@ -1,29 +1,59 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
 import facebook
+from django.utils.encoding import force_bytes
 from django.utils.functional import SimpleLazyObject
 from django.contrib.auth import BACKEND_SESSION_KEY
-from django.core.cache import cache
 
 import conf
+from . import stats
+from .graph import get_access_token_from_code, get_graph_api
+from .registry import get_current_app
+from .store import store
 
 FB_ACCESS_TOKEN_CACHE_KEY = '_fb_access_token_%s'
+FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY = '_fb_access_token_expires_%s'
+FB_ACCESS_TOKEN_REFRESH_CACHE_KEY = '_fb_access_token_refresh_%s'
+FB_ACCESS_TOKEN_LOCK_CACHE_KEY = '_fb_access_token_lock_%s_%s'
 FB_DATA_CACHE_KEY = '_fb_data_%s'
+FB_PROFILE_CACHE_KEY = '_fb_profile_%s'
+FB_CANVAS_NONCE_CACHE_KEY = '_fb_canvas_nonce_%s'
+FACEBOOK_BACKEND = 'django_facebook.auth.FacebookModelBackend'
+
+# Seconds between checks for the access_token of a code another process is
+# exchanging
+ACCESS_TOKEN_POLL_INTERVAL = 0.05
+# Left in place of the lock when the exchange of a code failed
+EXCHANGE_FAILED = 'failed'
+
 
+def auth_error(message):
+    """Return a facebook.AuthError like the ones facebook's answers give."""
+    return facebook.AuthError({'error': {'type': 'OAuthException',
+                                         'message': message}})
 
-def get_lazy_access_token(request):
-    if request.user.is_anonymous():
-        return None
-    code, use_redirect_uri = get_code_from_request(request)
-    fb_id = request.user.get_username()
+
+def get_lazy_access_token(request, fb_id=None):
+    """
+    Return a lazy access_token for the user of the request, or for the user
+    with ``fb_id`` if given.
+    """
+    if fb_id is None:
+        if request.user.is_anonymous():
+            return None
+        fb_id = request.user.get_username()
 
     def get_lazy():
-        access_token = get_cached_access_token(fb_id)
+        access_token, expires = get_cached_access_token_and_expiry(fb_id)
 
         if not access_token:
-            try:
-                access_token, expires_in = get_fresh_access_token(code, use_redirect_uri)
-                cache_access_token(fb_id, access_token, expires_in)
-            except facebook.AuthError:
-                raise
+            code, use_redirect_uri = get_code_from_request(request)
+            access_token = exchange_code(fb_id, code, use_redirect_uri)
+        elif expires:
+            refresh_access_token_if_needed(fb_id, expires)
 
         return access_token
 
@@ -59,20 +89,206 @@ def get_fresh_access_token(code, use_redirect_uri=True):
     Returns the access_token and the amount of seconds it expires in.
     """
     if not code:
-        raise facebook.AuthError('OAuthException', 'Their is no code to get an'
-            'access_token with. Reauthenticate the user')
+        raise auth_error('Their is no code to get an access_token with. '
+                         'Reauthenticate the user')
 
     try:
         # freaking facebook doesn't want a redirect_uri is somebody is logged
         # in throught the client-side...
-        kwargs = {'redirect_uri': ''} if not use_redirect_uri else {}
-        data = conf.auth.get_access_token_from_code(code, **kwargs)
+        redirect_uri = '' if not use_redirect_uri else None
+        with stats.timer('access_token.exchange'):
+            data = get_access_token_from_code(code, redirect_uri)
     except facebook.AuthError:
         raise
 
     return data['access_token'], data['expires']
 
 
+def exchange_code(user_id, code, use_redirect_uri=True):
+    """
+    Exchange the code for an access_token of the user and cache it, like
+    ``get_fresh_access_token``, but make sure only one request exchanges a
+    code, also across processes. Codes can only be used once, so concurrent
+    requests with the same code wait for the access_token to appear in the
+    cache instead, for at most FACEBOOK_ACCESS_TOKEN_LOCK_TIMEOUT seconds.
+
+    Returns the access_token, raises a facebook.AuthError if there is none.
+    """
+    if not code:
+        return get_fresh_access_token(code, use_redirect_uri)[0]
+
+    lock_key = FB_ACCESS_TOKEN_LOCK_CACHE_KEY % (
+        user_id, hashlib.sha1(force_bytes(code)).hexdigest())
+    token_key = FB_ACCESS_TOKEN_CACHE_KEY % user_id
+    timeout = conf.ACCESS_TOKEN_LOCK_TIMEOUT
+    deadline = time.time() + timeout
+    while True:
+        if store.add(lock_key, True, timeout):
+            # Another request may have exchanged the code and released the
+            # lock since we last looked, the code is used up then
+            access_token = store.get_shared(token_key)
+            if access_token:
+                store.delete(lock_key)
+                return access_token
+            try:
+                access_token, expires_in = get_fresh_access_token(
+                    code, use_redirect_uri)
+            except facebook.GraphAPIError:
+                # The code is used up, don't let the waiters try it again
+                store.set(lock_key, EXCHANGE_FAILED, timeout)
+                raise
+            except Exception:
+                store.delete(lock_key)
+                raise
+            cache_access_token(user_id, access_token, expires_in)
+            store.delete(lock_key)
+            return access_token
+
+        stats.incr('access_token.exchange_wait')
+        while time.time() < deadline:
+            time.sleep(ACCESS_TOKEN_POLL_INTERVAL)
+            access_token = store.get_shared(token_key)
+            if access_token:
+                return access_token
+            lock = store.get_shared(lock_key)
+            if lock == EXCHANGE_FAILED:
+                raise auth_error('Exchanging the code for an access_token '
+                                 'failed')
+            if lock is None:
+                # The exchange failed without using up the code, try it
+                # ourselves
+                break
+        else:
+            raise auth_error('Timed out waiting for the access_token to be '
+                             'exchanged')
+
+
+def exchange_access_token(access_token):
+    """
+    Exchange the access_token for a long lived one. Raise a
+    facebook.GraphAPIError if we can't.
+
+    Returns the new access_token and the amount of seconds it expires in.
+    """
+    app = get_current_app()
+    data = get_graph_api().request(
+        'oauth/access_token', {'grant_type': 'fb_exchange_token',
+                               'client_id': app.app_id,
+                               'client_secret': app.app_secret,
+                               'fb_exchange_token': access_token})
+    # Depending on the api version, facebook answers with a querystring
+    # containing 'expires', or json containing 'expires_in'. Long lived tokens
+    # are valid for 60 days.
+    expires_in = data.get('expires_in', data.get('expires', 60 * 24 * 3600))
+    return data['access_token'], int(expires_in)
+
+
+def refresh_access_token_if_needed(user_id, expires):
+    """
+    Queue ``tasks.extend_access_token`` for the user when
+    FACEBOOK_EXTEND_ACCESS_TOKENS is on and the access_token expires (at
+    timestamp ``expires``) within FACEBOOK_ACCESS_TOKEN_REFRESH_MARGIN
+    seconds. A refresh is only queued once per margin.
+
+    Returns whether a refresh was queued.
+    """
+    if not conf.EXTEND_ACCESS_TOKENS:
+        return False
+    if expires - time.time() > conf.ACCESS_TOKEN_REFRESH_MARGIN:
+        return False
+
+    try:
+        from .tasks import extend_access_token
+    except ImportError:
+        return False
+    if store.add(FB_ACCESS_TOKEN_REFRESH_CACHE_KEY % user_id, True,
+                 conf.ACCESS_TOKEN_REFRESH_MARGIN):
+        extend_access_token.delay(user_id, app=get_current_app().name)
+        return True
+    return False
+
+
+class SignedRequestCache(object):
+    """
+    Bounded LRU cache of verified signed_request payloads, keyed by the app
+    and a digest of the raw signed_request.
+
+    A browser sends the same ``fbsr_`` cookie for minutes, so this saves us
+    the base64 decoding, json parsing and HMAC check on most requests. Entries
+    expire ``ttl`` seconds after the ``issued_at`` of their payload. Only
+    successfully verified payloads are cached.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, signed_request, app=None):
+        """
+        Return the data in the signed_request of the app, or the active app,
+        like ``facebook.Auth.parse_signed_request`` does. Raises ValueError if
+        the signed_request is invalid.
+        """
+        app = app or get_current_app()
+        if not self.max_size:
+            with stats.timer('signed_request.parse'):
+                return app.parse_signed_request(signed_request)
+
+        key = (app.app_id, hashlib.sha1(force_bytes(signed_request)).digest())
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # re-insert to mark it as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                entry = dict(entry[1])
+            else:
+                self.misses += 1
+                entry = None
+        if entry is not None:
+            stats.incr('signed_request.cache_hit')
+            return entry
+
+        stats.incr('signed_request.cache_miss')
+        with stats.timer('signed_request.parse'):
+            data = app.parse_signed_request(signed_request)
+        if data:
+            expires = data.get('issued_at', now) + self.ttl
+            if expires > now:
+                with self._lock:
+                    self._entries[key] = (expires, data)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            data = dict(data)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+
+signed_request_cache = SignedRequestCache(conf.SIGNED_REQUEST_CACHE_SIZE,
+                                          conf.SIGNED_REQUEST_CACHE_TTL)
+
+
+def parse_signed_request(signed_request):
+    """
+    Parse and verify the signed_request of the active app, using the
+    per-process cache of already verified signed_requests.
+    """
+    return signed_request_cache.parse(signed_request)
+
+
 def get_signed_request_data(request):
     """
     Cache parsed signed_request cookie data, so we only do it once per
@@ -80,17 +296,71 @@ def get_signed_request_data(request):
     """
     if not hasattr(request, '_fb_cookie_data'):
         try:
-            data = conf.auth.parse_signed_request(request.COOKIES[conf.COOKIE_NAME])
+            data = parse_signed_request(
+                request.COOKIES[get_current_app().cookie_name])
         except (KeyError, ValueError, facebook.AuthError):
             data = {}
         request._fb_cookie_data = data
     return request._fb_cookie_data
 
 
+def verify_canvas_signed_request(signed_request):
+    """
+    Return the data of a signed_request facebook POSTed to a canvas page.
+    Raises ValueError if it is invalid, issued more than FACEBOOK_CANVAS_MAX_AGE
+    seconds ago, or, with FACEBOOK_CANVAS_REJECT_REPLAYS, was used before.
+
+    Used signed_requests are remembered in the cache until they expire, so
+    this works across processes. FACEBOOK_DEBUG_SIGNEDREQ is only checked for
+    its signature, so it can be used over and over.
+    """
+    data = parse_signed_request(signed_request)
+    if not data:
+        raise ValueError('signed_request is empty')
+    if conf.DEBUG_SIGNEDREQ and signed_request == conf.DEBUG_SIGNEDREQ:
+        return data
+    if data.get('issued_at', 0) + conf.CANVAS_MAX_AGE < time.time():
+        raise ValueError('signed_request expired')
+    if conf.CANVAS_REJECT_REPLAYS:
+        digest = hashlib.sha1(force_bytes(signed_request)).hexdigest()
+        if not store.add(FB_CANVAS_NONCE_CACHE_KEY % digest, True,
+                         conf.CANVAS_MAX_AGE):
+            raise ValueError('signed_request was used before')
+    return data
+
+
+def get_canvas_data(request):
+    """
+    Return the verified data of the canvas signed_request POSTed to the
+    request, or None when there is none. Raises ValueError when it is not
+    valid, see ``verify_canvas_signed_request``.
+
+    It is only verified once per request.
+    """
+    if not hasattr(request, '_fb_canvas_data'):
+        data, error = None, None
+        # Not only on POST, FacebookDebugCanvasMiddleware also sets it on GET
+        signed_request = request.POST.get('signed_request')
+        if signed_request:
+            try:
+                data = verify_canvas_signed_request(signed_request)
+            except (ValueError, facebook.AuthError) as e:
+                stats.incr('canvas.rejected')
+                error = ValueError(str(e))
+        request._fb_canvas_data = data, error
+    data, error = request._fb_canvas_data
+    if error is not None:
+        raise error
+    return data
+
+
 def is_fb_logged_in(request):
-    backendstr = 'django_facebook.auth.FacebookModelBackend'
-    return request.user.is_authenticated() and \
-        request.session.get(BACKEND_SESSION_KEY) == backendstr
+    if conf.STATELESS:
+        # The verified fbsr_ cookie is all the proof we need
+        return bool(get_signed_request_data(request).get('user_id'))
+    # Check the session first, so we don't load the user for nothing
+    return request.session.get(BACKEND_SESSION_KEY) == FACEBOOK_BACKEND and \
+        request.user.is_authenticated()
 
 
 class FacebookRequiredMixin(object):
@@ -109,28 +379,138 @@ class FacebookRequiredMixin(object):
 
 
 def cache_access_token(user_id, access_token, expires_in=3600):
-    """Cache the access_token for a user"""
-    cache.set(FB_ACCESS_TOKEN_CACHE_KEY % user_id, access_token, int(expires_in))
+    """
+    Cache the access_token for a user, together with the time it expires.
+    Queues a refresh of the access_token if it is short lived (see
+    ``refresh_access_token_if_needed``).
+    """
+    expires_in = int(expires_in)
+    expires = time.time() + expires_in
+    store.set_many({
+        FB_ACCESS_TOKEN_CACHE_KEY % user_id: access_token,
+        FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id: expires,
+    }, expires_in)
+    refresh_access_token_if_needed(user_id, expires)
 
 
 def get_cached_access_token(user_id, default=None):
-    return cache.get(FB_ACCESS_TOKEN_CACHE_KEY % user_id, default)
+    return store.get(FB_ACCESS_TOKEN_CACHE_KEY % user_id, default)
+
+
+def get_cached_access_token_and_expiry(user_id):
+    """
+    Return the cached access_token of the user and the timestamp it expires,
+    or ``None`` for either of them if it is not cached.
+    """
+    token_key = FB_ACCESS_TOKEN_CACHE_KEY % user_id
+    expires_key = FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id
+    data = store.get_many([token_key, expires_key])
+    return data.get(token_key), data.get(expires_key)
 
 
 def del_cached_access_token(user_id):
-    cache.delete(FB_ACCESS_TOKEN_CACHE_KEY % user_id)
+    store.delete_many([FB_ACCESS_TOKEN_CACHE_KEY % user_id,
+                       FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id])
 
 
 def cache_fb_user_data(user_id, data, expires_in=None):
     if not expires_in:
-        cache.set(FB_DATA_CACHE_KEY % user_id, data)
+        store.set(FB_DATA_CACHE_KEY % user_id, data)
     else:
-        cache.set(FB_DATA_CACHE_KEY % user_id, data, int(expires_in))
+        store.set(FB_DATA_CACHE_KEY % user_id, data, int(expires_in))
 
 
 def del_cached_fb_user_data(user_id):
-    cache.delete(FB_DATA_CACHE_KEY % user_id)
+    store.delete(FB_DATA_CACHE_KEY % user_id)
 
 
 def get_cached_fb_user_data(user_id, default=None):
-    return cache.get(FB_DATA_CACHE_KEY % user_id, default)
+    return store.get(FB_DATA_CACHE_KEY % user_id, default)
+
+
+# Bulk versions of the above, that do a single cache call for many users.
+
+def _ttl_bucket(expires_in):
+    """
+    Round a ttl down to the minute, so tokens expiring around the same time
+    can be stored with a single ``set_many``.
+    """
+    expires_in = int(expires_in)
+    return expires_in - expires_in % 60 if expires_in > 60 else expires_in
+
+
+def cache_access_tokens(tokens):
+    """
+    Cache the access_tokens for many users. ``tokens`` maps facebook ids to
+    ``(access_token, expires_in)`` tuples.
+    """
+    by_ttl = {}
+    now = time.time()
+    for user_id, (access_token, expires_in) in tokens.items():
+        data = by_ttl.setdefault(_ttl_bucket(expires_in), {})
+        data[FB_ACCESS_TOKEN_CACHE_KEY % user_id] = access_token
+        data[FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id] = now + int(expires_in)
+    for ttl, data in by_ttl.items():
+        store.set_many(data, ttl)
+
+
+def get_cached_access_tokens(user_ids):
+    """
+    Return a dict mapping facebook ids to their cached access_token. Users
+    without a cached access_token are left out.
+    """
+    keys = dict((FB_ACCESS_TOKEN_CACHE_KEY % u, u) for u in user_ids)
+    return dict((keys[k], v) for k, v in store.get_many(keys.keys()).items())
+
+
+def get_cached_access_token_expiries(user_ids):
+    """
+    Return a dict mapping facebook ids to the timestamp their cached
+    access_token expires.
+    """
+    keys = dict((FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % u, u) for u in user_ids)
+    return dict((keys[k], v) for k, v in store.get_many(keys.keys()).items())
+
+
+def del_cached_access_tokens(user_ids):
+    keys = []
+    for user_id in user_ids:
+        keys.append(FB_ACCESS_TOKEN_CACHE_KEY % user_id)
+        keys.append(FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id)
+    store.delete_many(keys)
+
+
+def cache_fb_users_data(users_data, expires_in=None):
+    """
+    Cache the data for many users. ``users_data`` maps facebook ids to their
+    data.
+    """
+    data = dict((FB_DATA_CACHE_KEY % u, d) for u, d in users_data.items())
+    if not expires_in:
+        store.set_many(data)
+    else:
+        store.set_many(data, int(expires_in))
+
+
+def get_cached_fb_users_data(user_ids):
+    """
+    Return a dict mapping facebook ids to their cached data. Users without
+    cached data are left out.
+    """
+    keys = dict((FB_DATA_CACHE_KEY % u, u) for u in user_ids)
+    return dict((keys[k], v) for k, v in store.get_many(keys.keys()).items())
+
+
+def del_cached_fb_users_data(user_ids):
+    store.delete_many([FB_DATA_CACHE_KEY % u for u in user_ids])
+
+
+def del_cached_fb_users(user_ids):
+    """Delete the cached access_tokens, data and profiles of the users."""
+    keys = []
+    for user_id in user_ids:
+        keys.append(FB_ACCESS_TOKEN_CACHE_KEY % user_id)
+        keys.append(FB_ACCESS_TOKEN_EXPIRES_CACHE_KEY % user_id)
+        keys.append(FB_DATA_CACHE_KEY % user_id)
+        keys.append(FB_PROFILE_CACHE_KEY % user_id)
+    store.delete_many(keys)
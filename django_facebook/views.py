@@ -1,19 +1,24 @@
 import urllib
+import json
 import logging
 
 from django.core.urlresolvers import reverse
 from django.contrib.auth import logout, authenticate
 from django.http import (HttpResponse, HttpResponseRedirect,
-    HttpResponseNotAllowed, HttpResponseBadRequest)
+    HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseForbidden)
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
 
 import facebook
+import requests
 
 import conf
 from .auth import login, FacebookModelBackend
-from .utils import cache_access_token, is_fb_logged_in
+from .graph import get_access_token_from_code, get_graph_api
+from .registry import activate_for_request
+from .utils import cache_access_token, is_fb_logged_in, parse_signed_request
+from .webhooks import dispatch_updates, parse_changes, verify_signature
 
 
 log = logging.getLogger('django_facebook.views')
@@ -23,6 +28,7 @@ def fb_server_login(request):
     """View that accepts the redirect from Facebook after the user signs in
     there.
     """
+    activate_for_request(request)
     # TODO error_reason when user denies
     next = request.GET.get('next')
     if not next:
@@ -40,11 +46,11 @@ def fb_server_login(request):
     try:
         scheme = request.is_secure() and 'https' or 'http'
         redirect_uri = '%s://%s%s' % (scheme, request.get_host(), reverse('djfb_login'))
-        token = request.facebook.auth.get_access_token_from_code(code,
-            redirect_uri=redirect_uri)
+        token = get_access_token_from_code(code, redirect_uri=redirect_uri)
         access_token, expires_in = token['access_token'], token['expires']
-        fb_user = facebook.GraphAPI(access_token).get_object('me')
-    except facebook.GraphAPIError, e:
+        # We only need the id, so don't let facebook send the whole profile
+        fb_user = get_graph_api(access_token).get_object('me', fields='id')
+    except (facebook.GraphAPIError, requests.RequestException), e:
         log.error('Could not log into facebook because: %s' % e)
         # best we can do is redirect to login page again...
         return HttpResponseRedirect(next)
@@ -110,6 +116,52 @@ def fb_logout(request, next=None):
 
     response = HttpResponseRedirect(next)
     # Facebook sets the fbsr_ cookie for the "base_domain" in the fbm_ cookie
-    cookie_domain = request.COOKIES.get('fbm_%s' % conf.APP_ID, '=').split('=')[1]
-    response.delete_cookie(conf.COOKIE_NAME, domain=cookie_domain)
+    app = activate_for_request(request)
+    cookie_domain = request.COOKIES.get('fbm_%s' % app.app_id, '=').split('=')[1]
+    response.delete_cookie(app.cookie_name, domain=cookie_domain)
     return response
+
+
+@csrf_exempt
+def fb_webhook(request):
+    """
+    Endpoint for facebook webhooks (real-time updates) on users, that can be
+    used as the deauthorize callback url of the app as well.
+
+    Answers the subscription handshake with the challenge when the verify
+    token matches FACEBOOK_WEBHOOK_VERIFY_TOKEN. Change notifications must be
+    signed with the app secret, deauthorize callbacks carry a signed_request.
+    The cache invalidation is deferred to a task, see ``webhooks``.
+    """
+    activate_for_request(request)
+    if request.method == 'GET':
+        if request.GET.get('hub.mode') == 'subscribe' and \
+                conf.WEBHOOK_VERIFY_TOKEN and \
+                request.GET.get('hub.verify_token') == conf.WEBHOOK_VERIFY_TOKEN:
+            return HttpResponse(request.GET.get('hub.challenge', ''))
+        return HttpResponseForbidden('Invalid verify token')
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['GET', 'POST'])
+
+    body = request.body
+    if 'signed_request' in request.POST:
+        try:
+            data = parse_signed_request(request.POST['signed_request'])
+        except (ValueError, facebook.AuthError):
+            data = None
+        if not data or not data.get('user_id'):
+            return HttpResponseBadRequest('Invalid signed_request')
+        dispatch_updates({}, [str(data['user_id'])])
+        return HttpResponse('OK')
+
+    if not verify_signature(body, request.META.get('HTTP_X_HUB_SIGNATURE')):
+        log.warning('Webhook with an invalid X-Hub-Signature')
+        return HttpResponseForbidden('Invalid signature')
+    try:
+        changes = parse_changes(json.loads(body.decode('utf-8')))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid json')
+    if changes:
+        dispatch_updates(changes, [])
+    return HttpResponse('OK')
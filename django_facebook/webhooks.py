@@ -0,0 +1,94 @@
+"""
+Handling of facebook webhooks (real-time updates) and deauthorize callbacks,
+so cached user data is dropped when it changes on facebook instead of when it
+expires.
+"""
+import hashlib
+import hmac
+import logging
+
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+
+import conf
+from . import stats
+from .registry import get_current_app
+from .store import store
+from .utils import FB_DATA_CACHE_KEY, FB_PROFILE_CACHE_KEY, del_cached_fb_users
+
+log = logging.getLogger('django_facebook.webhooks')
+
+
+def verify_signature(body, signature):
+    """
+    Return whether ``signature``, the value of the ``X-Hub-Signature`` header,
+    is the HMAC-SHA1 of the raw request body with the secret of the active
+    app.
+    """
+    if not signature or not signature.startswith('sha1='):
+        return False
+    expected = hmac.new(get_current_app().hmac_key, force_bytes(body),
+                        hashlib.sha1).hexdigest()
+    return constant_time_compare(signature[5:], expected)
+
+
+def parse_changes(payload):
+    """
+    Return a dict mapping the facebook ids of the users in a webhook payload
+    to the list of fields that changed. Entries for other objects than users
+    are ignored.
+    """
+    if payload.get('object') != 'user':
+        return {}
+    changes = {}
+    for entry in payload.get('entry', []):
+        user_id = entry.get('uid') or entry.get('id')
+        if not user_id:
+            continue
+        fields = entry.get('changed_fields') or \
+            [change.get('field') for change in entry.get('changes', [])]
+        changed = changes.setdefault(str(user_id), set())
+        changed.update(field for field in fields if field)
+    return dict((user_id, sorted(fields))
+                for user_id, fields in changes.items())
+
+
+def handle_updates(changes, deauthorized):
+    """
+    Drop the cached data of the users in ``changes``, a dict mapping facebook
+    ids to the fields that changed, and everything cached for the facebook
+    ids in ``deauthorized``, in a single cache call.
+
+    Cached profiles are only dropped when one of the changed fields is in
+    FACEBOOK_PROFILE_FIELDS, or when facebook didn't say what changed.
+    """
+    deauthorized = set(deauthorized)
+    keys = []
+    for user_id, fields in changes.items():
+        if user_id in deauthorized:
+            continue
+        keys.append(FB_DATA_CACHE_KEY % user_id)
+        if not fields or set(fields) & set(conf.PROFILE_FIELDS):
+            keys.append(FB_PROFILE_CACHE_KEY % user_id)
+    if keys:
+        store.delete_many(keys)
+    if deauthorized:
+        del_cached_fb_users(deauthorized)
+    stats.incr('webhooks.changed', len(changes))
+    stats.incr('webhooks.deauthorized', len(deauthorized))
+    log.debug('Handled changes of %s users, %s users deauthorized'
+              % (len(changes), len(deauthorized)))
+
+
+def dispatch_updates(changes, deauthorized):
+    """
+    Hand the updates to ``tasks.handle_webhook_updates``, or handle them
+    right away when celery is not installed.
+    """
+    try:
+        from .tasks import handle_webhook_updates
+    except ImportError:
+        handle_updates(changes, deauthorized)
+    else:
+        handle_webhook_updates.delay(changes, list(deauthorized),
+                                     app=get_current_app().name)
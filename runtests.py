@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Run the django_facebook tests with throwaway settings::
+
+    python runtests.py [test labels]
+"""
+import sys
+
+import django
+from django.conf import settings
+
+settings.configure(
+    SECRET_KEY='tests',
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django_facebook',
+    ],
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    },
+    MIDDLEWARE_CLASSES=[],
+    ROOT_URLCONF='django_facebook.urls',
+    FACEBOOK_APP_ID='1234',
+    FACEBOOK_APP_SECRET='test-secret',
+    FACEBOOK_REDIRECT_URI='http://testserver/',
+    FACEBOOK_WEBHOOK_VERIFY_TOKEN='test-verify-token',
+)
+
+
+def main():
+    django.setup()
+    from django.test.utils import get_runner
+    runner = get_runner(settings)()
+    failures = runner.run_tests(sys.argv[1:] or ['django_facebook'])
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,11 @@ setup(
     author='Tino de Bruijn',
     author_email='tinodb@gmail.com',
     url='http://github.com/tino/django-facebook2',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        'django>=1.5',
+        'django>=1.8',
         'facebook2>=2.2.1',
     ],
     classifiers=[